@@ -1,4 +1,10 @@
 # from .setmac_dbus import SetMacDbusHandler
 from .serial_to_mac import SerialToMacAddress, SAPLING_MAC_OUI, SAPLING_HEMC_DEVICE_TYPE, SAPLING_HEMC_NUM_OF_MAC
-from .local_file_process import LocalFileProcess, PATH_LOCAL_HEMC_MAC_LIST 
+from .local_file_process import LocalFileProcess, PATH_LOCAL_HEMC_MAC_LIST, LEDGER_COMPRESSION_GZIP
 from .remote_file_process import RemoteFileProcess, PATH_REMOTE_HEMC_MAC_LIST, PATH_REMOTE_MUTEX_UNLOCKED, PATH_REMOTE_MUTEX_LOCKED, PATH_LOCAL_MUTEX_UNLOCKED
+from .provision_orchestrator import ProvisionOrchestrator, DeviceWriter, PrintDeviceWriter, FakeDeviceWriter
+from .allocation_server import AllocationServer, PATH_HEMCD_JOURNAL, HEMCD_PORT
+from .hemcd_client import HemcdClient, HemcdFileProcess
+from .allocation_bitmap import AllocationBitmap, PATH_LOCAL_HEMC_MAC_BITMAP
+from .remote_file_cache import RemoteFileCache, PATH_LOCAL_HEMC_MAC_CACHE
+from .async_remote_file_process import AsyncRemoteFileProcess
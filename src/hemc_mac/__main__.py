@@ -1,4 +1,5 @@
 import argparse
+import logging
 from .serial_to_mac import SerialToMacAddress, SAPLING_MAC_OUI, SAPLING_HEMC_DEVICE_TYPE, SAPLING_HEMC_NUM_OF_MAC
 from .local_file_process import LocalFileProcess, PATH_LOCAL_HEMC_MAC_LIST 
 from .remote_file_process import RemoteFileProcess, PATH_REMOTE_HEMC_MAC_LIST, PATH_REMOTE_MUTEX_UNLOCKED, PATH_REMOTE_MUTEX_LOCKED, PATH_LOCAL_MUTEX_UNLOCKED
@@ -6,13 +7,27 @@ from .remote_file_process import RemoteFileProcess, PATH_REMOTE_HEMC_MAC_LIST, P
 SAPLING_ETH_MAC_ADDR_VARS = ['ethaddr', 'eth1addr', 'eth2addr', 'eth3addr', 'eth4addr', 'eth5addr']
 
 from .sftp_client import SftpClient
+from .remote_file_cache import PATH_LOCAL_HEMC_MAC_CACHE
+from .allocation_bitmap import PATH_LOCAL_HEMC_MAC_BITMAP
 from .ftp_client import FtpClient
+from .allocation_server import AllocationServer, HEMCD_PORT, PATH_HEMCD_JOURNAL
+from .hemcd_client import HemcdClient, HemcdFileProcess
+from .provision_orchestrator import ProvisionOrchestrator, PrintDeviceWriter, PROVISION_MAX_WORKERS, PROVISION_DEVICE_TIMEOUT, PROVISION_DEVICE_RETRIES
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="SFTP MAC serial number updater")
+    parser.add_argument('command', nargs='?', choices=['serve'], help="'serve' runs the allocation server owning the local MAC list file")
     parser.add_argument('--credentials', type=str, default='credentials.txt', help='Path to credentials file')
     parser.add_argument('--clean', action='store_true', help='Clean up local and remote files')
     parser.add_argument('--init', action='store_true', help='Create initial serial file and mutex on SFTP server')
+    parser.add_argument('--debug-local-files', action='store_true', help='Stage the files in the configured local paths and keep them')
+    parser.add_argument('--show', action='store_true', help='Show the last entry of the MAC list file')
+    parser.add_argument('--compact', action='store_true', help='Rewrite the gzip compressed MAC list file in large chunks')
+    parser.add_argument('--release', type=str, nargs='+', help='Release MAC addresses of scrapped boards to issue them again')
+    parser.add_argument('--targets', type=str, nargs='+', help='Program MAC addresses to several devices concurrently')
+    parser.add_argument('--jobs', type=int, default=PROVISION_MAX_WORKERS, help='Number of devices programmed at the same time')
+    parser.add_argument('--device-timeout', type=int, default=PROVISION_DEVICE_TIMEOUT, help='Timeout of a single programming attempt, seconds')
+    parser.add_argument('--retries', type=int, default=PROVISION_DEVICE_RETRIES, help='Number of retries for a device which failed programming')
     args = parser.parse_args()
 
     credentials_file = args.credentials
@@ -21,6 +36,9 @@ if __name__ == '__main__':
     config_from_file = {}
     # All the keys should be present in the credentials file
     must_have_list_of_keys = ['server', 'name', 'password', 'protocol', 'port']
+    if args.command == 'serve':
+        # Server address (host name or Unix socket path) is the only key required to serve
+        must_have_list_of_keys = ['server']
     try:
         """
         Example of credentials file:
@@ -43,6 +61,11 @@ PATH_REMOTE_HEMC_MAC_LIST: uploads/HEMC_MAC.txt
 PATH_REMOTE_MUTEX_UNLOCKED: uploads/mutex.unlocked
 PATH_REMOTE_MUTEX_LOCKED: uploads/mutex.locked
 PATH_LOCAL_MUTEX_UNLOCKED: /tmp/mutex.unlocked
+PATH_LOCAL_HEMC_MAC_CACHE: /tmp/HEMC_MAC.cache.txt
+PATH_LOCAL_HEMC_MAC_BITMAP: /tmp/HEMC_MAC.bitmap
+#SSH_COMPRESSION: yes
+#LEDGER_COMPRESSION: gzip
+#PATH_REMOTE_HEMC_MAC_LIST: uploads/HEMC_MAC.txt.gz
 
 # Sapling FTP configuration file
 Server: patch.sapling-inc.com
@@ -59,6 +82,8 @@ PATH_REMOTE_HEMC_MAC_LIST: tmp/HEMC_MAC.txt
 PATH_REMOTE_MUTEX_UNLOCKED: tmp/mutex.unlocked
 PATH_REMOTE_MUTEX_LOCKED: tmp/mutex.locked
 PATH_LOCAL_MUTEX_UNLOCKED: /tmp/mutex.unlocked
+PATH_LOCAL_HEMC_MAC_CACHE: /tmp/HEMC_MAC.cache.txt
+PATH_LOCAL_HEMC_MAC_BITMAP: /tmp/HEMC_MAC.bitmap
 
         """
         with open(credentials_file, 'r') as f:
@@ -74,6 +99,13 @@ PATH_LOCAL_MUTEX_UNLOCKED: /tmp/mutex.unlocked
             if len(value) == 0:
                 raise ValueError(f"Value for '{key}' cannot be empty.")
             config_from_file[key] = value
+        if config_from_file.get('protocol', '').lower() == 'hemcd':
+            # The allocation server does not need the user name, the password is the shared secret
+            must_have_list_of_keys = ['server', 'protocol']
+        if args.command == 'serve' or config_from_file.get('protocol', '').lower() == 'hemcd':
+            # The shared secret is required on TCP socket
+            if not config_from_file.get('server', '/').startswith('/'):
+                must_have_list_of_keys.append('password')
         missing_keys = [key for key in must_have_list_of_keys if key not in config_from_file]
         if missing_keys:
             raise ValueError(f"Credentials file must contain the following keys: {', '.join(missing_keys)}.")
@@ -81,36 +113,94 @@ PATH_LOCAL_MUTEX_UNLOCKED: /tmp/mutex.unlocked
         print(f"Error reading credentials: {e}")
         exit(1)
 
+    serial_to_mac_address = SerialToMacAddress(
+                            oui = config_from_file.get('oui', SAPLING_MAC_OUI),
+                            device_type = config_from_file.get('device_type', SAPLING_HEMC_DEVICE_TYPE),
+                            num_of_macs= len(SAPLING_ETH_MAC_ADDR_VARS))
+
+    if args.command == 'serve':
+        """
+        Example of the allocation server configuration file:
+            Server: /run/hemcd.sock
+            OUI: 60:36:96
+            DEVICE_TYPE: 10
+            PATH_LOCAL_HEMC_MAC_LIST: /var/lib/hemc_mac/HEMC_MAC.txt
+            PATH_HEMCD_JOURNAL: /var/lib/hemc_mac/HEMC_MAC.journal
+            #LEDGER_COMPRESSION: gzip
+        Server may be a host name to listen on TCP port (Port: 5021),
+        then 'Password' (the shared secret of the clients) is required.
+        The file is created with '--init' and removed with '--clean', the clients can not do it.
+        """
+        logging.basicConfig(level=logging.INFO)
+        allocation_server = AllocationServer(
+                                mac_process=serial_to_mac_address,
+                                server=config_from_file['server'],
+                                port=int(config_from_file.get('port', HEMCD_PORT)),
+                                local_storage_cls=LocalFileProcess,
+                                local_file_path=config_from_file.get('path_local_hemc_mac_list', PATH_LOCAL_HEMC_MAC_LIST),
+                                journal_path=config_from_file.get('path_hemcd_journal', PATH_HEMCD_JOURNAL),
+                                bitmap_file_path=config_from_file.get('path_local_hemc_mac_bitmap', PATH_LOCAL_HEMC_MAC_BITMAP),
+                                compression=config_from_file.get('ledger_compression'),
+                                secret=config_from_file.get('password'))
+        allocation_server.start()
+        if clean_mode:
+            allocation_server.cleanup()
+            print("Cleanup completed successfully.")
+        if init_mode:
+            allocation_server.init()
+            print("Initialization completed successfully.")
+        if args.compact:
+            allocation_server.compact()
+            print("Compaction completed successfully.")
+        print(f"Serving on {config_from_file['server']}")
+        try:
+            allocation_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        exit(0)
+
     remote_storage_cls = config_from_file['protocol'].lower()
     if remote_storage_cls == 'sftp':
         remote_storage_cls = SftpClient
     elif remote_storage_cls == 'ftp':
         remote_storage_cls = FtpClient
+    elif remote_storage_cls == 'hemcd':
+        remote_storage_cls = HemcdClient
+        if init_mode or clean_mode:
+            print("The allocation server file is created and removed on the server only, use 'serve --init' or 'serve --clean'.")
+            exit(1)
     else:
-        print(f"Unsupported FTP client: {remote_storage_cls}. Supported clients are 'sftp' and 'ftp'.")
+        print(f"Unsupported FTP client: {remote_storage_cls}. Supported clients are 'sftp', 'ftp' and 'hemcd'.")
         exit(1)
 
+    remote_storage_kwargs = {}
+    if remote_storage_cls is SftpClient:
+        # Compression of the SSH transport, worth it for slow links
+        remote_storage_kwargs['compress'] = config_from_file.get('ssh_compression', 'no').lower() in ('yes', 'true', '1')
     remote_storage_cls.init(
             server=config_from_file['server'],
-            name=config_from_file['name'],
-            password=config_from_file['password'],
-            port=int(config_from_file['port']),
-            timeout=int(config_from_file.get('timeout', 10)))
+            name=config_from_file.get('name'),
+            password=config_from_file.get('password'),
+            port=int(config_from_file.get('port', HEMCD_PORT)),
+            timeout=int(config_from_file.get('timeout', 10)),
+            **remote_storage_kwargs)
 
-    serial_to_mac_address = SerialToMacAddress(
-                            oui = config_from_file.get('oui', SAPLING_MAC_OUI),
-                            device_type = config_from_file.get('device_type', SAPLING_HEMC_DEVICE_TYPE),
-                            num_of_macs= len(SAPLING_ETH_MAC_ADDR_VARS))
-
-    remote_file_process = RemoteFileProcess(
-                            local_file_path=config_from_file.get('path_local_hemc_mac_list', PATH_LOCAL_HEMC_MAC_LIST),
-                            remote_file_path=config_from_file.get('path_remote_hemc_mac_list', PATH_REMOTE_HEMC_MAC_LIST),
-                            path_remote_mutex_unlocked=config_from_file.get('path_remote_mutex_unlocked', PATH_REMOTE_MUTEX_UNLOCKED),
-                            path_remote_mutex_locked=config_from_file.get('path_remote_mutex_locked', PATH_REMOTE_MUTEX_LOCKED),
-                            path_local_mutex_unlocked=config_from_file.get('path_local_mutex_unlocked', PATH_LOCAL_MUTEX_UNLOCKED),
-                            local_storage_cls = LocalFileProcess,
-                            remote_storage_cls=remote_storage_cls,
-                            mac_process=serial_to_mac_address)
+    if remote_storage_cls is HemcdClient:
+        remote_file_process = HemcdFileProcess(remote_storage_cls=remote_storage_cls)
+    else:
+        remote_file_process = RemoteFileProcess(
+                                local_file_path=config_from_file.get('path_local_hemc_mac_list', PATH_LOCAL_HEMC_MAC_LIST),
+                                remote_file_path=config_from_file.get('path_remote_hemc_mac_list', PATH_REMOTE_HEMC_MAC_LIST),
+                                path_remote_mutex_unlocked=config_from_file.get('path_remote_mutex_unlocked', PATH_REMOTE_MUTEX_UNLOCKED),
+                                path_remote_mutex_locked=config_from_file.get('path_remote_mutex_locked', PATH_REMOTE_MUTEX_LOCKED),
+                                path_local_mutex_unlocked=config_from_file.get('path_local_mutex_unlocked', PATH_LOCAL_MUTEX_UNLOCKED),
+                                local_storage_cls = LocalFileProcess,
+                                remote_storage_cls=remote_storage_cls,
+                                mac_process=serial_to_mac_address,
+                                cache_file_path=config_from_file.get('path_local_hemc_mac_cache', PATH_LOCAL_HEMC_MAC_CACHE),
+                                bitmap_file_path=config_from_file.get('path_local_hemc_mac_bitmap', PATH_LOCAL_HEMC_MAC_BITMAP),
+                                debug_local_files=args.debug_local_files,
+                                compression=config_from_file.get('ledger_compression'))
 
 
     """
@@ -133,8 +223,34 @@ PATH_LOCAL_MUTEX_UNLOCKED: /tmp/mutex.unlocked
         # Initialize the SFTP server by creating a mutex file and a MAC list file
         remote_file_process.init()
         print("Initialization completed successfully.")
-    normal_mode = not (init_mode or clean_mode)
-    if normal_mode:
+    if args.show:
+        total_number, serial_number, mac = remote_file_process.read_last_entry()
+        print(f"Total: {total_number} Serial: {serial_number:04x} MAC: {mac}")
+    if args.release:
+        remote_file_process.release_atomicaly(args.release)
+        print(f"Released {len(args.release)} MAC addresses.")
+    if args.compact:
+        remote_file_process.compact_atomicaly()
+        print("Compaction completed successfully.")
+    normal_mode = not (init_mode or clean_mode or args.show or args.release or args.compact)
+    if normal_mode and args.targets:
+        orchestrator = ProvisionOrchestrator(
+                            remote_file_process=remote_file_process,
+                            writer=PrintDeviceWriter(SAPLING_ETH_MAC_ADDR_VARS),
+                            max_workers=args.jobs,
+                            timeout=args.device_timeout,
+                            retries=args.retries)
+        results = orchestrator.run(args.targets)
+        failed = False
+        for result in results:
+            print(f"[{result['target']}] {result['result']}: {', '.join(result['mac_addresses'])}")
+            if result['result'] != "OK":
+                print(f"[{result['target']}] Error: {result['error']}")
+                failed = True
+            if result['result'] == "TIMEOUT":
+                print(f"[{result['target']}] Check the board, release the MAC addresses with --release if it is not programmed.")
+        exit(1 if failed else 0)
+    elif normal_mode:
         remote_file_process.process_file_atomicaly()
         for i, eth_addr_var in enumerate(SAPLING_ETH_MAC_ADDR_VARS):
             _, _, mac = remote_file_process.file_data[i]
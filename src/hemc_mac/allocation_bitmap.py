@@ -0,0 +1,151 @@
+import os
+import re
+import struct
+import tempfile
+import logging
+from .local_file_process import LEDGER_STATUS_UNUSED, LEDGER_STATUS_RELEASED
+"""
+AllocationBitmap is a compact index of the issued MAC addresses:
+1 bit per address for the lower 24 bits of the MAC (device type and serial number),
+2 MB for the whole space.
+
+The bitmap is built from the MAC list file in one streaming pass and then
+updated incrementally from the offset where the previous pass stopped,
+the file is only appended to. Entries without a status word and REUSED
+entries set the bit, UNUSED and RELEASED entries clear it.
+The fingerprint of the file at the offset (see LocalFileProcess.fingerprint())
+is kept too, the bitmap is rebuilt if the file was created again or restored.
+
+The bitmap is saved next to the MAC list file:
+    HEMCBMP2 | offset (8 bytes, little endian) | fingerprint (32 bytes) | 2 MB of bits
+"""
+
+PATH_LOCAL_HEMC_MAC_BITMAP = '/tmp/HEMC_MAC.bitmap'
+BITMAP_NUM_OF_BITS = 1 << 24
+BITMAP_MAGIC = b'HEMCBMP2'
+BITMAP_HEADER = struct.Struct('<8sQ32s')
+FREE_STATUSES = (LEDGER_STATUS_UNUSED, LEDGER_STATUS_RELEASED)
+# Any byte with at least one clear bit
+NOT_FULL_BYTE = re.compile(b'[^\xff]')
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+
+class AllocationBitmap():
+    def __init__(self, bitmap_file_path=PATH_LOCAL_HEMC_MAC_BITMAP):
+        self._bitmap_file_path = bitmap_file_path
+        self._bits = bytearray(BITMAP_NUM_OF_BITS // 8)
+        # Offset in the MAC list file up to which the bitmap is built and the fingerprint of the file there
+        self._offset = 0
+        self._fingerprint = b''
+
+
+    @staticmethod
+    def mac_to_index(mac):
+        """
+        The index is the lower 24 bits of the MAC address.
+        The OUI and the device type are not checked, use SerialToMacAddress.mac_to_serial().
+        """
+        words = mac.split(':')
+        if len(words) != 6:
+            raise ValueError(f"Invalid MAC address {mac}.")
+        return int(''.join(words[3:]), 16)
+
+
+    def is_issued(self, mac):
+        index = self.mac_to_index(mac)
+        return bool(self._bits[index >> 3] & (1 << (index & 7)))
+
+
+    def set(self, mac):
+        index = self.mac_to_index(mac)
+        self._bits[index >> 3] |= 1 << (index & 7)
+
+
+    def clear(self, mac):
+        index = self.mac_to_index(mac)
+        self._bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+
+    def free_indexes(self, first, last):
+        """
+        Yield the indexes of the clear bits in the range [first, last], lowest first.
+        """
+        pos = first >> 3
+        end = (last >> 3) + 1
+        while True:
+            match = NOT_FULL_BYTE.search(self._bits, pos, end)
+            if match is None:
+                return
+            pos = match.start()
+            byte = self._bits[pos]
+            for bit in range(8):
+                index = (pos << 3) | bit
+                if first <= index <= last and not byte & (1 << bit):
+                    yield index
+            pos += 1
+
+
+    def update(self, local_storage):
+        """
+        Apply the entries appended to the MAC list file since the last update.
+        The bitmap is rebuilt if the file does not continue the one it was built from.
+        """
+        if self._offset and (self._offset > local_storage.size() or not local_storage.is_line_start(self._offset)
+                             or local_storage.fingerprint(self._offset) != self._fingerprint):
+            logger.info("The MAC list file has changed, rebuilding the bitmap.")
+            self.rebuild(local_storage)
+            return
+        offset = self._offset
+        for _, _, mac, status, offset in local_storage.iter_entries(self._offset):
+            if status in FREE_STATUSES:
+                self.clear(mac)
+            else:
+                self.set(mac)
+        if offset != self._offset:
+            self._offset = offset
+            self._fingerprint = local_storage.fingerprint(offset)
+
+
+    def rebuild(self, local_storage):
+        self.reset()
+        self.update(local_storage)
+
+
+    def reset(self):
+        self._bits = bytearray(BITMAP_NUM_OF_BITS // 8)
+        self._offset = 0
+        self._fingerprint = b''
+
+
+    def load(self):
+        """
+        Load the saved bitmap, return False if it does not exist or is corrupted.
+        """
+        try:
+            with open(self._bitmap_file_path, 'rb') as f:
+                magic, offset, fingerprint = BITMAP_HEADER.unpack(f.read(BITMAP_HEADER.size))
+                bits = f.read()
+        except (OSError, struct.error):
+            return False
+        if magic != BITMAP_MAGIC or len(bits) != len(self._bits):
+            return False
+        self._bits = bytearray(bits)
+        self._offset = offset
+        self._fingerprint = fingerprint
+        return True
+
+
+    def save(self):
+        # Unique temporary file, several transactions may save the bitmap at the same time
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self._bitmap_file_path)))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(BITMAP_HEADER.pack(BITMAP_MAGIC, self._offset, self._fingerprint))
+            f.write(self._bits)
+        os.replace(tmp_path, self._bitmap_file_path)
+
+
+    def delete(self):
+        if os.path.exists(self._bitmap_file_path):
+            os.remove(self._bitmap_file_path)
+
@@ -0,0 +1,425 @@
+import hmac
+import json
+import os
+import socketserver
+import threading
+import logging
+from .local_file_process import LocalFileProcess, PATH_LOCAL_HEMC_MAC_LIST, LEDGER_STATUS_UNUSED, LEDGER_STATUS_RELEASED, LEDGER_STATUS_REUSED
+from .allocation_bitmap import AllocationBitmap, PATH_LOCAL_HEMC_MAC_BITMAP, FREE_STATUSES
+"""
+AllocationServer owns the MAC address file locally and hands out MAC blocks
+over a Unix or TCP socket ('python -m hemc_mac serve').
+
+The current total number and serial number are kept in memory, so the
+allocations are serialized in memory instead of on a remote rename.
+New lines are group-committed: all the lines queued while the previous group
+was written are written to the write-ahead journal with a single fsync,
+then appended to the file. The file itself is synced and the journal is
+truncated every HEMCD_CHECKPOINT_LINES lines, on shutdown the journal is removed.
+
+The journal starts with the size of the file at the last checkpoint:
+    # 12345
+On start the file is truncated to this size and the journal is replayed.
+
+The protocol is a JSON object per line in both directions:
+    {"command": "allocate", "num_of_blocks": 1}
+    {"result": "OK", "file_data": [[1, 1, "60:36:96:10:00:01"], ...]}
+Commands: allocate, mark_unused, release, read_last_entry, issued_mac_addresses.
+The file is created, removed and compacted only locally ('serve --init', 'serve --clean', 'serve --compact').
+
+If the server has a shared secret ('Password' in its configuration), every
+request must carry it: {"command": ..., "secret": "..."}. The secret is
+required to listen on TCP, note that it is sent in clear text.
+
+The bitmap of the issued MAC addresses is kept in memory, released
+MAC addresses are issued again, lowest first. The total numbers of the
+issued serial numbers are kept in memory too (loaded with one pass over
+the file on start), so release does not read the file.
+On error the reply is {"result": "FAIL", "error": "..."}.
+"""
+
+PATH_HEMCD_JOURNAL = '/tmp/HEMC_MAC.journal'
+HEMCD_PORT = 5021
+HEMCD_CHECKPOINT_LINES = 1000
+HEMCD_MAX_NUM_OF_BLOCKS = 256
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+
+class AllocationRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                reply = self.server.allocation_server.dispatch(request)
+                reply["result"] = "OK"
+            except Exception as e:
+                logger.error(f"Error: {e}")
+                reply = {"result": "FAIL", "error": str(e)}
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+            self.wfile.flush()
+
+
+class ThreadingUnixStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class AllocationServer():
+    def __init__(self,
+                 mac_process,
+                 server,
+                 port=HEMCD_PORT,
+                 local_storage_cls=LocalFileProcess,
+                 local_file_path=PATH_LOCAL_HEMC_MAC_LIST,
+                 journal_path=PATH_HEMCD_JOURNAL,
+                 bitmap_file_path=PATH_LOCAL_HEMC_MAC_BITMAP,
+                 checkpoint_lines=HEMCD_CHECKPOINT_LINES,
+                 compression=None,
+                 secret=None):
+        """
+        server is a host name for TCP socket or a path (starting with '/') for Unix socket.
+        secret is the shared secret the clients must send, it is required for TCP socket.
+        If compression is 'gzip', the MAC list file is stored as gzip chunks, one per group commit.
+        """
+        self._mac_process = mac_process
+        self._server = server
+        self._port = port
+        self._local_file_path = local_file_path
+        self._local_storage = local_storage_cls(local_file_path=local_file_path, compression=compression)
+        self._journal_path = journal_path
+        self._checkpoint_lines = checkpoint_lines
+        self._secret = secret
+        self._bitmap = AllocationBitmap(bitmap_file_path)
+        self._journal = None
+        self._socket_server = None
+        self._committer = None
+        self._cond = threading.Condition()
+        # In-memory state, protected by self._cond
+        self._entry = None
+        self._totals = {}
+        self._pending = []
+        self._pending_seq = 0
+        self._committed_seq = 0
+        self._commit_errors = {}
+        self._uncheckpointed = 0
+        self._stopping = False
+
+
+    def start(self):
+        """
+        Recover the file from the journal, load the current entry and start listening.
+        """
+        if not self._server.startswith('/') and not self._secret:
+            raise ValueError("A shared secret is required to listen on TCP socket.")
+        self._recover()
+        if self._local_storage.exists():
+            self._entry = self._local_storage.read()
+            self._bitmap.load()
+            self._bitmap.update(self._local_storage)
+            self._load_totals()
+        else:
+            logger.error(f"{self._local_file_path} does not exist, run 'init' first.")
+        self._committer = threading.Thread(target=self._commit_loop, daemon=True)
+        self._committer.start()
+        if self._server.startswith('/'):
+            if os.path.exists(self._server):
+                os.remove(self._server)
+            self._socket_server = ThreadingUnixStreamServer(self._server, AllocationRequestHandler)
+        else:
+            self._socket_server = ThreadingTCPServer((self._server, self._port), AllocationRequestHandler)
+        self._socket_server.allocation_server = self
+
+
+    def serve_forever(self):
+        try:
+            self._socket_server.serve_forever()
+        finally:
+            self.stop()
+
+
+    def shutdown(self):
+        """
+        Stop serve_forever() from another thread.
+        """
+        self._socket_server.shutdown()
+
+
+    def stop(self):
+        """
+        Commit the queued lines, sync the file, remove the journal and close the socket.
+        """
+        with self._cond:
+            if self._stopping:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        self._committer.join()
+        self._socket_server.server_close()
+        if self._server.startswith('/') and os.path.exists(self._server):
+            os.remove(self._server)
+        # After a clean shutdown there is nothing to replay
+        if self._local_storage.exists():
+            self._local_storage.append([], sync=True)
+            self._bitmap.update(self._local_storage)
+            self._bitmap.save()
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+
+
+    def dispatch(self, request):
+        """
+        Handle a request of a client. init and cleanup are not available to the clients.
+        """
+        if self._secret and not hmac.compare_digest(str(request.get('secret', '')).encode(), self._secret.encode()):
+            raise PermissionError("Authentication failed.")
+        command = request.get('command')
+        if command == 'allocate':
+            num_of_blocks = int(request.get('num_of_blocks', 1))
+            if not 1 <= num_of_blocks <= HEMCD_MAX_NUM_OF_BLOCKS:
+                raise ValueError(f"num_of_blocks must be from 1 to {HEMCD_MAX_NUM_OF_BLOCKS}.")
+            return {"file_data": self.allocate(num_of_blocks)}
+        if command == 'mark_unused':
+            self.mark_unused(request.get('file_data', []))
+            return {}
+        if command == 'release':
+            self.release(request.get('mac_addresses', []))
+            return {}
+        if command == 'read_last_entry':
+            return {"entry": self.read_last_entry()}
+        if command == 'issued_mac_addresses':
+            return {"mac_addresses": self.issued_mac_addresses(request.get('mac_addresses', []))}
+        raise ValueError(f"Unsupported command: {command}.")
+
+
+    def allocate(self, num_of_blocks=1):
+        """
+        Allocate num_of_blocks MAC blocks, return when they are committed to the journal.
+        Released MAC addresses are issued first.
+        """
+        with self._cond:
+            if self._entry is None:
+                raise ValueError(f"{self._local_file_path} is not initialized.")
+            entry = self._entry
+            serial_number = entry[1]
+            base = AllocationBitmap.mac_to_index(self._mac_process.serial_to_mac(0))
+            free_serials = (index - base for index in self._bitmap.free_indexes(base + 1, base + serial_number))
+            file_data = []
+            for _ in range(num_of_blocks):
+                block = self._mac_process.generate_mac_address_list(*entry, free_serials=free_serials)
+                file_data.extend(block)
+                # Reused serial numbers do not advance the counter
+                entry = (block[-1][0], max([entry[1]] + [serial for _, serial, _ in block]), block[-1][2])
+            self._entry = entry
+            for total, serial, mac in file_data:
+                self._bitmap.set(mac)
+                self._totals[serial] = total
+            self._commit([self._local_storage.format_entry(total, serial, mac, LEDGER_STATUS_REUSED if serial <= serial_number else None)
+                          for total, serial, mac in file_data])
+        return file_data
+
+
+    def mark_unused(self, file_data):
+        """
+        Record the entries issued earlier as UNUSED.
+        """
+        with self._cond:
+            for _, serial_number, mac in file_data:
+                self._bitmap.clear(mac)
+                self._totals.pop(serial_number, None)
+            self._commit([self._local_storage.format_entry(total_number, serial_number, mac, LEDGER_STATUS_UNUSED)
+                          for total_number, serial_number, mac in file_data])
+
+
+    def release(self, mac_addresses):
+        """
+        Record the MAC addresses issued earlier as RELEASED, they are issued again.
+        """
+        mac_addresses = list(dict.fromkeys(mac.lower() for mac in mac_addresses))
+        # The bitmap knows the lower 24 bits only, check the OUI and the device type first
+        serial_numbers = [self._mac_process.mac_to_serial(mac) for mac in mac_addresses]
+        with self._cond:
+            not_issued = [mac for mac, serial_number in zip(mac_addresses, serial_numbers) if serial_number not in self._totals]
+            if not_issued:
+                raise ValueError(f"MAC addresses are not issued: {', '.join(not_issued)}.")
+            lines = []
+            for mac, serial_number in zip(mac_addresses, serial_numbers):
+                self._bitmap.clear(mac)
+                lines.append(self._local_storage.format_entry(self._totals.pop(serial_number), serial_number, mac, LEDGER_STATUS_RELEASED))
+            self._commit(lines)
+
+
+    def read_last_entry(self):
+        with self._cond:
+            if self._entry is None:
+                raise ValueError(f"{self._local_file_path} is not initialized.")
+            return self._entry
+
+
+    def issued_mac_addresses(self, mac_addresses):
+        """
+        Return the MAC addresses which are issued (not UNUSED or RELEASED).
+        """
+        mac_addresses = [mac.lower() for mac in mac_addresses]
+        for mac in mac_addresses:
+            self._mac_process.mac_to_serial(mac)
+        with self._cond:
+            if self._entry is None:
+                raise ValueError(f"{self._local_file_path} is not initialized.")
+            return [mac for mac in mac_addresses if self._bitmap.is_issued(mac)]
+
+
+    def init(self):
+        """
+        Create the file with the initial entry.
+        """
+        with self._cond:
+            self._wait_idle()
+            mac = self._mac_process.serial_to_mac(0)
+            self._local_storage.create(mac=mac)
+            self._reset_journal()
+            self._entry = self._local_storage.read()
+            self._bitmap.rebuild(self._local_storage)
+            self._load_totals()
+
+
+    def compact(self):
+        """
+        Rewrite the compressed file in large chunks, see LocalFileProcess.compact().
+        """
+        with self._cond:
+            self._wait_idle()
+            self._local_storage.compact()
+            self._reset_journal()
+            self._bitmap.rebuild(self._local_storage)
+
+
+    def cleanup(self):
+        """
+        Remove the file and the journal.
+        """
+        with self._cond:
+            self._wait_idle()
+            self._local_storage.delete()
+            self._reset_journal()
+            self._entry = None
+            self._totals = {}
+            self._bitmap.delete()
+            self._bitmap.reset()
+
+
+    def _load_totals(self):
+        """
+        Stream the file once to find the total numbers of the issued serial numbers.
+        """
+        self._totals = {}
+        for total_number, serial_number, _, status, _ in self._local_storage.iter_entries():
+            if status in FREE_STATUSES:
+                self._totals.pop(serial_number, None)
+            else:
+                self._totals[serial_number] = total_number
+
+
+    def _wait_idle(self):
+        # Called with self._cond held
+        while self._pending or self._committed_seq < self._pending_seq:
+            self._cond.wait()
+
+
+    def _commit(self, lines):
+        """
+        Queue the lines for the committer thread and wait until they are in the journal.
+        Called with self._cond held.
+        """
+        if self._stopping:
+            raise RuntimeError("The server is stopping.")
+        self._pending.extend(lines)
+        self._pending_seq += 1
+        seq = self._pending_seq
+        self._cond.notify_all()
+        while self._committed_seq < seq:
+            self._cond.wait()
+        error = self._commit_errors.pop(seq, None)
+        if error:
+            raise error
+
+
+    def _commit_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                lines = self._pending
+                self._pending = []
+                first_seq = self._committed_seq + 1
+                last_seq = self._pending_seq
+            error = None
+            try:
+                self._write_group(lines)
+            except Exception as e:
+                logger.error(f"Failed to commit {len(lines)} lines: {e}")
+                error = e
+            with self._cond:
+                if error:
+                    for seq in range(first_seq, last_seq + 1):
+                        self._commit_errors[seq] = error
+                self._committed_seq = last_seq
+                self._cond.notify_all()
+
+
+    def _write_group(self, lines):
+        if self._journal is None:
+            self._reset_journal()
+        self._journal.write(''.join(lines))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._uncheckpointed += len(lines)
+        sync = self._uncheckpointed >= self._checkpoint_lines
+        self._local_storage.append(lines, sync=sync)
+        if sync:
+            self._reset_journal()
+
+
+    def _reset_journal(self):
+        """
+        Start a new journal with the current size of the file.
+        """
+        size = os.path.getsize(self._local_file_path) if self._local_storage.exists() else 0
+        if self._journal:
+            self._journal.close()
+        self._journal = open(self._journal_path, 'w')
+        self._journal.write(f"# {size}\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._uncheckpointed = 0
+
+
+    def _recover(self):
+        """
+        Truncate the file to the size at the last checkpoint and replay the journal.
+        """
+        if not os.path.exists(self._journal_path):
+            return
+        with open(self._journal_path, 'r') as f:
+            lines = f.readlines()
+        if not lines or not lines[0].startswith('# '):
+            return
+        size = int(lines[0][2:].strip())
+        # Partially written last line was never acknowledged
+        lines = [line for line in lines[1:] if line.endswith('\n')]
+        if not self._local_storage.exists():
+            return
+        with open(self._local_file_path, 'r+') as f:
+            f.truncate(size)
+        self._local_storage.append(lines, sync=True)
+        logger.info(f"Replayed {len(lines)} lines from {self._journal_path}.")
+        self._reset_journal()
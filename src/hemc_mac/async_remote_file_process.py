@@ -0,0 +1,130 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .remote_file_process import ATTEMPTS_GET_SERIAL_NUMBER, LOCK_RETRY_DELAY
+"""
+AsyncRemoteFileProcess drives a RemoteFileProcess from an asyncio event loop.
+
+The blocking SFTP/FTP calls run on a dedicated single-thread executor,
+one per AsyncRemoteFileProcess, so they are executed in order and do not
+occupy the default executor. The mutex lock is retried with asyncio.sleep.
+
+If the allocation is cancelled, the mutex is always unlocked: the unlock is
+queued on the same executor after the call in progress, and it is shielded
+from the cancellation. Note that the transaction already in progress is
+completed, so the cancelled allocation may still be recorded in the file.
+If the unlock fails while another exception is propagating, it is logged only.
+
+To allocate on several servers concurrently, use one AsyncRemoteFileProcess
+per server, each with its own remote storage class:
+    server1 = RemoteFileProcess(remote_storage_cls=SftpClient.new(server='192.168.1.102', ...), ...)
+    server2 = RemoteFileProcess(remote_storage_cls=FtpClient.new(server='patch.sapling-inc.com', ...), ...)
+    async with AsyncRemoteFileProcess(server1) as p1, AsyncRemoteFileProcess(server2) as p2:
+        file_data1, file_data2 = await asyncio.gather(p1.allocate(), p2.allocate())
+"""
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+
+class AsyncRemoteFileProcess():
+    def __init__(self, remote_file_process, executor=None):
+        """
+        executor must run the calls in order (single worker), it is created if not given.
+        """
+        self._process = remote_file_process
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix='hemc_mac')
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+
+    def close(self):
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+
+    async def allocate(self, num_of_blocks=1):
+        """
+        Allocate num_of_blocks MAC blocks, see RemoteFileProcess.process_file_atomicaly().
+        """
+        file_data = await self._process_atomicaly(lambda local_storage: self._process.allocate(local_storage, num_of_blocks))
+        self._process.file_data = file_data
+        return file_data
+
+
+    async def mark_unused(self, file_data):
+        await self._process_atomicaly(lambda local_storage: self._process.mark_unused(local_storage, file_data))
+
+
+    async def release(self, mac_addresses):
+        mac_addresses = self._process.check_mac_addresses(mac_addresses)
+        await self._process_atomicaly(lambda local_storage: self._process.release(local_storage, mac_addresses))
+
+
+    async def init(self):
+        await self._run(self._process.init)
+
+
+    async def cleanup(self):
+        await self._run(self._process.cleanup)
+
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+
+    async def _process_atomicaly(self, process):
+        """
+        Run the transaction steps of RemoteFileProcess (see RemoteFileProcess.connect())
+        without blocking the event loop.
+        """
+        # The state is changed by the executor thread only
+        state = {"h_remote": None, "locked": False}
+
+        def connect():
+            state["h_remote"] = self._process.connect()
+
+        def try_lock(attempt):
+            state["locked"] = self._process.try_lock_mutex(state["h_remote"], attempt)
+            return state["locked"]
+
+        def finish():
+            # Runs after the call in progress, even if the allocation is cancelled
+            if state["h_remote"] is None:
+                return
+            try:
+                if state["locked"]:
+                    self._process.unlock_mutex(state["h_remote"])
+            finally:
+                self._process.disconnect(state["h_remote"])
+
+        succeeded = False
+        try:
+            await self._run(connect)
+            # LOCK MUTEX!
+            for attempt in range(ATTEMPTS_GET_SERIAL_NUMBER):
+                if await self._run(try_lock, attempt):
+                    break
+                logger.error(f"Retrying in {LOCK_RETRY_DELAY} second... (Attempt {attempt + 1})")
+                await asyncio.sleep(LOCK_RETRY_DELAY)
+            result = await self._run(self._process.transaction, state["h_remote"], process)
+            succeeded = True
+            return result
+        except Exception as e:
+            logger.error(f"Error while processing {self._process.remote_file_path}: {e}")
+            raise
+        finally:
+            # Always UNLOCK MUTEX!
+            try:
+                await asyncio.shield(self._run(finish))
+            except Exception as e:
+                # Do not hide the exception (or the cancellation) which is propagating
+                if succeeded:
+                    raise
+                logger.error(f"Failed to unlock the mutex of {self._process.remote_file_path}: {e}")
@@ -1,5 +1,10 @@
 from ftplib import FTP
 from ftplib import error_perm
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+# Command not recognized, syntax error, not implemented, not implemented for the parameter
+FTP_UNSUPPORTED_COMMAND_CODES = ('500', '501', '502', '504')
 
 class FtpWrapper():
     """
@@ -16,6 +21,10 @@ class FtpWrapper():
         self._client.remove(sftp_path)
     def rename(self, old_path, new_path):
         self._client.rename(old_path, new_path)
+    def stat(self, sftp_path):
+        return self._client.stat(sftp_path)
+    def get_tail(self, sftp_path, local_path, offset):
+        self._client.get_tail(sftp_path, local_path, offset)
     def close(self):
         self._client.close_()
 
@@ -33,11 +42,54 @@ class SaplingFTP(FTP):
                     raise e
 
 
+    def get_tail(self, ftp_path, local_path, offset):
+        """
+        Download the part of the file starting at offset (REST command).
+        The local file is truncated to offset and the downloaded part is appended.
+        Raise NotImplementedError if the server does not support REST.
+        """
+        with open(local_path, 'r+b') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            try:
+                self.retrbinary(f'RETR {ftp_path}', f.write, rest=offset)
+            except error_perm as e:
+                if '550' in str(e):
+                    raise FileNotFoundError(f"File {ftp_path} not found on server.")
+                elif str(e)[:3] in FTP_UNSUPPORTED_COMMAND_CODES:
+                    raise NotImplementedError(f"FTP server does not support REST: {e}")
+                else:
+                    raise e
+
+
     def put(self, local_path, ftp_path):
         with open(local_path, 'rb') as f:
             self.storbinary(f'STOR {ftp_path}', f)
 
 
+    def stat(self, ftp_path):
+        """
+        Get the size (SIZE) and the modification time (MDTM) of the file.
+        The attributes are named as in SFTP: st_size, st_mtime.
+        Raise NotImplementedError if the server does not support SIZE or MDTM (RFC 3659).
+        """
+        try:
+            # SIZE is only reliable in binary mode
+            self.voidcmd('TYPE I')
+            size = self.size(ftp_path)
+            resp = self.voidcmd(f'MDTM {ftp_path}')
+        except error_perm as e:
+            if '550' in str(e):
+                raise FileNotFoundError(f"File {ftp_path} not found on server.")
+            elif str(e)[:3] in FTP_UNSUPPORTED_COMMAND_CODES:
+                raise NotImplementedError(f"FTP server does not support SIZE/MDTM: {e}")
+            else:
+                raise e
+        # 213 YYYYMMDDHHMMSS[.sss] in UTC
+        mtime = datetime.strptime(resp.split()[1][:14], '%Y%m%d%H%M%S')
+        return SimpleNamespace(st_size=size, st_mtime=mtime.replace(tzinfo=timezone.utc).timestamp())
+
+
     def rename(self, fromname, toname):
         try:
             ret = super().rename(fromname, toname)
@@ -91,6 +143,17 @@ class FtpClient():
         cls._ftp_port = port
 
 
+    @classmethod
+    def new(cls, **kwargs):
+        """
+        Return a subclass configured for one more server,
+        so that several servers can be used at the same time.
+        """
+        client_cls = type(cls.__name__, (cls,), {})
+        client_cls.init(**kwargs)
+        return client_cls
+
+
     @classmethod
     def connect(cls):
         # Connect to FTP server
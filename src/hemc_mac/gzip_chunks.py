@@ -0,0 +1,95 @@
+import gzip
+import struct
+"""
+The MAC list file may be stored as a sequence of gzip chunks, every append
+adds a chunk. The result is a valid multi-member gzip file ('zcat' works).
+
+Every chunk is a gzip member with the lines followed by an empty gzip member
+(the footer) which holds the size of the chunk in the FEXTRA field,
+subfield 'HM'. The footer has a fixed size, so the chunks can be walked
+from the end of the file and the tail is read without decompressing
+the whole file.
+    | data member | footer | data member | footer | ...
+"""
+
+GZIP_CHUNK_SIZE = 64 * 1024  # Maximum size of uncompressed data in one chunk
+GZIP_FOOTER_SUBFIELD = b'HM'
+GZIP_MAGIC = b'\x1f\x8b'
+# ID1 ID2 CM FLG(FEXTRA) MTIME XFL OS XLEN | SI1 SI2 LEN | chunk size
+GZIP_FOOTER_HEADER = struct.Struct('<2sBBIBBH2sHQ')
+# Empty final deflate block, CRC32 and ISIZE of empty data
+GZIP_FOOTER_TRAILER = b'\x03\x00' + struct.pack('<II', 0, 0)
+GZIP_FOOTER_SIZE = GZIP_FOOTER_HEADER.size + len(GZIP_FOOTER_TRAILER)
+
+
+def compress_chunks(data, chunk_size=GZIP_CHUNK_SIZE):
+    """
+    Compress the lines into one or more chunks, the chunks end at the end of a line.
+    """
+    result = []
+    start = 0
+    while start < len(data):
+        end = len(data)
+        if end - start > chunk_size:
+            end = data.rfind(b'\n', start, start + chunk_size) + 1 or end
+        member = gzip.compress(data[start:end], mtime=0)
+        footer = GZIP_FOOTER_HEADER.pack(GZIP_MAGIC, 8, 4, 0, 0, 255, 12,
+                                         GZIP_FOOTER_SUBFIELD, 8, len(member))
+        result.append(member + footer + GZIP_FOOTER_TRAILER)
+        start = end
+    return b''.join(result)
+
+
+def _iter_members_reversed(f):
+    """
+    Yield the offset and the size of the data members of the open binary file,
+    the last member first. Only the footers are read.
+    """
+    end = f.seek(0, 2)
+    while end > 0:
+        if end < GZIP_FOOTER_SIZE:
+            raise ValueError("Corrupted gzip chunk file.")
+        f.seek(end - GZIP_FOOTER_SIZE)
+        fields = GZIP_FOOTER_HEADER.unpack(f.read(GZIP_FOOTER_HEADER.size))
+        if fields[0] != GZIP_MAGIC or fields[7] != GZIP_FOOTER_SUBFIELD:
+            raise ValueError("Corrupted gzip chunk file.")
+        start = end - GZIP_FOOTER_SIZE - fields[9]
+        if start < 0:
+            raise ValueError("Corrupted gzip chunk file.")
+        yield start, fields[9]
+        end = start
+
+
+def iter_chunks_reversed(f):
+    """
+    Yield the uncompressed chunks of the open binary file, the last chunk first.
+    """
+    for start, size in _iter_members_reversed(f):
+        f.seek(start)
+        yield gzip.decompress(f.read(size))
+
+
+def iter_chunks(f, offset=0):
+    """
+    Yield the uncompressed chunks of the open binary file starting at the chunk boundary offset,
+    together with the offset of the next chunk. Every chunk is read and decompressed once.
+    """
+    if offset >= f.seek(0, 2):
+        return
+    # The chunk boundaries are found from the footers, walking back to offset
+    members = []
+    for start, size in _iter_members_reversed(f):
+        if start < offset:
+            raise ValueError(f"Offset {offset} is not a chunk boundary.")
+        members.append((start, size))
+        if start == offset:
+            break
+    for start, size in reversed(members):
+        f.seek(start)
+        yield gzip.decompress(f.read(size)), start + size + GZIP_FOOTER_SIZE
+
+
+def is_chunk_start(f, offset):
+    f.seek(offset)
+    magic = f.read(2)
+    return magic == GZIP_MAGIC or (offset > 0 and magic == b'')
@@ -0,0 +1,135 @@
+import json
+import socket
+import logging
+from .allocation_server import HEMCD_PORT
+"""
+Client side of the allocation server ('Protocol: HEMCD').
+
+HemcdFileProcess has the same interface as RemoteFileProcess, but the
+allocations are done by the server, so there is no file transfer and no mutex.
+The file is created and removed on the server only ('serve --init', 'serve --clean').
+The password is the shared secret of the server.
+"""
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+
+class HemcdConnection():
+    def __init__(self, sock, secret=None):
+        self._sock = sock
+        self._secret = secret
+        self._file = sock.makefile('rwb')
+
+
+    def request(self, request):
+        """
+        Send the request and return the reply, raise an exception if the request failed.
+        """
+        if self._secret:
+            request = dict(request, secret=self._secret)
+        self._file.write((json.dumps(request) + '\n').encode())
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the allocation server.")
+        reply = json.loads(line)
+        if reply.get('result') != "OK":
+            raise RuntimeError(f"Allocation server: {reply.get('error')}")
+        return reply
+
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+class HemcdClient():
+    _server = None
+    _timeout = None
+    _port = None
+    _password = None
+
+
+    @classmethod
+    def init(cls,
+                 server,
+                 name=None,
+                 password=None,
+                 port=HEMCD_PORT,
+                 timeout=2):
+        """
+        server is a host name for TCP socket or a path (starting with '/') for Unix socket.
+        password is the shared secret of the server, name is not used.
+        """
+        cls._server = server
+        cls._password = password
+        cls._timeout = timeout
+        cls._port = port
+
+
+    @classmethod
+    def connect(cls):
+        if cls._server.startswith('/'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(cls._timeout)
+            sock.connect(cls._server)
+        else:
+            sock = socket.create_connection((cls._server, cls._port), timeout=cls._timeout)
+        return HemcdConnection(sock, cls._password)
+
+
+    @classmethod
+    def disconnect(cls):
+        pass
+
+
+class HemcdFileProcess():
+    def __init__(self, remote_storage_cls=HemcdClient):
+        self._remote_storage_cls = remote_storage_cls
+        self.file_data = []
+
+
+    def _request(self, request):
+        h_remote = self._remote_storage_cls.connect()
+        try:
+            return h_remote.request(request)
+        finally:
+            h_remote.close()
+            self._remote_storage_cls.disconnect()
+
+
+    def process_file_atomicaly(self, num_of_blocks=1):
+        """
+        Allocate num_of_blocks MAC blocks on the allocation server.
+        """
+        reply = self._request({"command": "allocate", "num_of_blocks": num_of_blocks})
+        self.file_data = [tuple(entry) for entry in reply['file_data']]
+        return self.file_data
+
+
+    def mark_unused_atomicaly(self, file_data):
+        self._request({"command": "mark_unused", "file_data": [list(entry) for entry in file_data]})
+
+
+    def release_atomicaly(self, mac_addresses):
+        self._request({"command": "release", "mac_addresses": list(mac_addresses)})
+
+
+    def read_last_entry(self):
+        return tuple(self._request({"command": "read_last_entry"})['entry'])
+
+
+    def issued_mac_addresses(self, mac_addresses):
+        return self._request({"command": "issued_mac_addresses", "mac_addresses": list(mac_addresses)})['mac_addresses']
+
+
+    def compact_atomicaly(self):
+        raise RuntimeError("The file is compacted on the allocation server only, run 'python -m hemc_mac serve --compact' there.")
+
+
+    def cleanup(self):
+        raise RuntimeError("The file is removed on the allocation server only, run 'python -m hemc_mac serve --clean' there.")
+
+
+    def init(self):
+        raise RuntimeError("The file is created on the allocation server only, run 'python -m hemc_mac serve --init' there.")
@@ -1,5 +1,9 @@
+import hashlib
+import itertools
 import os
+import tempfile
 from datetime import datetime
+from .gzip_chunks import compress_chunks, iter_chunks, iter_chunks_reversed, is_chunk_start
 """
 LocalFileProcess class for managing a local file that stores
 the total number, serial number, and MAC address.
@@ -9,13 +13,37 @@ CRUD operations are supported:
 - read: Retrieve the total number, serial number, and MAC address.
 - update: Save the total number, serial number, and MAC address to the file.
 - delete: Remove the local file.
+
+An entry may carry an optional status word after the DateTime column.
+Such entries do not advance the serial counter:
+- UNUSED: the MAC block of a board that failed programming, free again.
+- RELEASED: the MAC address of a scrapped or RMA'd board, free again.
+- REUSED: a free MAC address issued again, advances the total number only.
+- COUNTER: not an entry, repeats the current total number, serial number
+  and MAC address. The older clients take them from the last line, so an append
+  whose last line has a status word is followed by a COUNTER line.
+
+With compression='gzip' the file is stored as gzip chunks, one (or more for
+large appends) per append, see gzip_chunks. The last entries are read from
+the last chunks only and the offsets are the offsets of the chunks.
+Small chunks compress worse (about 2.3 times for a transaction of 6 lines,
+about 7 times for 64 KB chunks), compact() rewrites the file in large chunks.
 """
 
 PATH_LOCAL_HEMC_MAC_LIST = '/tmp/HEMC_MAC.txt'
+LEDGER_STATUS_UNUSED = 'UNUSED'
+LEDGER_STATUS_RELEASED = 'RELEASED'
+LEDGER_STATUS_REUSED = 'REUSED'
+LEDGER_STATUS_COUNTER = 'COUNTER'
+LEDGER_COMPRESSION_GZIP = 'gzip'
+LEDGER_FINGERPRINT_SIZE = 256
 
 class LocalFileProcess:
-    def __init__(self, local_file_path=PATH_LOCAL_HEMC_MAC_LIST):
+    def __init__(self, local_file_path=PATH_LOCAL_HEMC_MAC_LIST, compression=None):
+        if compression not in (None, LEDGER_COMPRESSION_GZIP):
+            raise ValueError(f"Unsupported compression {compression}.")
         self._local_file_path = local_file_path
+        self._compression = compression
 
 
     def create(self, total_number=0, serial_number=0, mac="00:00:00:00:00:00", header=None):
@@ -25,45 +53,194 @@ class LocalFileProcess:
         self.delete()  # Ensure the file is clean before creating
         if header is None:
             header="Total   Serial  MAC               DateTime"
-        with open(self._local_file_path, 'w') as file:
-            file.write(f"{header}\n")
-        self.update(total_number, serial_number, mac)
+        self.append([f"{header}\n", self.format_entry(total_number, serial_number, mac)])
 
 
     def read(self):
         """
         Retrieve the total number, serial number, and MAC address from the local file.
+        The serial number and MAC address are taken from the last entry without a status word,
+        the total number also counts the REUSED entries.
+        """
+        return self._read_counter(self._iter_lines_reversed())
+
+
+    @staticmethod
+    def _read_counter(lines_reversed):
+        """
+        Return the total number, serial number, and MAC address from the lines, the last line first.
         """
         total_number, serial_number = None, None
-        with open(self._local_file_path, 'r') as file:
-            # Read the last line of the file
-            lines = file.readlines()
-            if not lines:
-                raise ValueError("The MAC address file is empty.")
-        last_line_words_list = lines[-1].strip().split()
-        total_number_dec = last_line_words_list[0].strip()
+        # Find the last line without a status word: Total Serial MAC Date Time (or a COUNTER line)
+        last_line_words_list = None
+        empty = True
+        for line in lines_reversed:
+            empty = False
+            words = line.strip().split()
+            if not words or not words[0].isdigit():
+                continue
+            untagged = len(words) == 5 or words[5:] == [LEDGER_STATUS_COUNTER]
+            if total_number is None and (untagged or words[5:] == [LEDGER_STATUS_REUSED]):
+                total_number = int(words[0].strip(), 10)
+            if untagged:
+                last_line_words_list = words
+                break
+        if empty:
+            raise ValueError("The MAC address file is empty.")
+        if last_line_words_list is None:
+            raise ValueError("The MAC address file has no entries.")
         serial_number_dec = last_line_words_list[1].strip()
         mac = last_line_words_list[2].strip()
         # Convert the serial from string to integer
-        total_number = int(total_number_dec, 10)
         serial_number = int(serial_number_dec, 16)
         return total_number, serial_number, mac
 
 
-    def update(self, total_number, serial_number, mac):
+    def _iter_lines_reversed(self):
+        """
+        Yield the lines of the file, the last line first.
+        Only the chunks up to the line looked for are decompressed.
+        """
+        if self._compression:
+            with open(self._local_file_path, 'rb') as file:
+                for chunk in iter_chunks_reversed(file):
+                    yield from reversed(chunk.decode().splitlines(keepends=True))
+            return
+        with open(self._local_file_path, 'r') as file:
+            lines = file.readlines()
+        yield from reversed(lines)
+
+
+    def iter_entries(self, offset=0):
+        """
+        Stream the entries starting at the byte offset (must be the start of a line,
+        or of a chunk if the file is compressed).
+        Yield total number, serial number, MAC address, status (or None)
+        and the offset of the next line (of the next chunk if the file is compressed).
+        The header and incomplete last line are skipped, a compressed file
+        with an incomplete last chunk raises ValueError.
+        """
+        with open(self._local_file_path, 'rb') as file:
+            if self._compression:
+                for chunk, offset in iter_chunks(file, offset):
+                    for line in chunk.splitlines(keepends=True):
+                        entry = self._parse_entry(line)
+                        if entry:
+                            yield entry + (offset,)
+                return
+            file.seek(offset)
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                entry = self._parse_entry(line)
+                if entry:
+                    yield entry + (offset,)
+
+
+    def _parse_entry(self, line):
+        """
+        Return total number, serial number, MAC address and status (or None),
+        None if the line is not an entry (e.g. a COUNTER line).
+        """
+        words = line.decode().split()
+        if len(words) < 5 or not words[0].isdigit() or words[5:] == [LEDGER_STATUS_COUNTER]:
+            return None
+        status = words[5] if len(words) > 5 else None
+        return int(words[0], 10), int(words[1], 16), words[2], status
+
+
+    def update(self, total_number, serial_number, mac, status=None):
         """
         Save the total number, serial number, and MAC address to the local file.
+        If status is given it is appended after the DateTime column.
+        """
+        self.append([self.format_entry(total_number, serial_number, mac, status)])
+
+
+    def format_entry(self, total_number, serial_number, mac, status=None):
+        """
+        Format a line of the file with the current time/date.
+        """
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # extent total number to 7 symbols with trailing spaces
+        total_number = str(total_number).ljust(7)
+        serial_number = f"{serial_number:04x}"
+        # extend serial number to 7 symols with trailing spaces
+        serial_number = serial_number.ljust(7)
+        status = f" {status}" if status else ""
+        return f"{total_number} {serial_number} {mac} {current_time}{status}\n"
+
+
+    def append(self, lines, sync=False):
+        """
+        Append the formatted lines to the local file with a single write.
+        If the last line has a status word, a COUNTER line is appended after it.
+        If sync is True the file is flushed to the disk.
+        """
+        lines = list(lines)
+        words = lines[-1].split() if lines else []
+        if words[:1] and words[0].isdigit() and words[5:] not in ([], [LEDGER_STATUS_COUNTER]):
+            lines_reversed = itertools.chain(reversed(lines), self._iter_lines_reversed())
+            lines.append(self.format_entry(*self._read_counter(lines_reversed), LEDGER_STATUS_COUNTER))
+        data = ''.join(lines).encode()
+        if self._compression:
+            data = compress_chunks(data)
+        with open(self._local_file_path, 'ab') as file:
+            file.write(data)
+            if sync:
+                file.flush()
+                os.fsync(file.fileno())
+
+
+    def compact(self):
+        """
+        Rewrite the compressed file in chunks of GZIP_CHUNK_SIZE, the file is replaced atomically.
+        The file is no longer the one the offsets were taken from. The plain file is not changed.
+        """
+        if not self._compression:
+            return
+        with open(self._local_file_path, 'rb') as file:
+            data = b''.join(chunk for chunk, _ in iter_chunks(file))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self._local_file_path)))
+        with os.fdopen(fd, 'wb') as file:
+            file.write(compress_chunks(data))
+        os.replace(tmp_path, self._local_file_path)
+
+
+    def exists(self):
+        return os.path.exists(self._local_file_path)
+
+
+    def size(self):
+        return os.path.getsize(self._local_file_path)
+
+
+    def is_line_start(self, offset):
+        """
+        Check that a line of the file starts at the byte offset
+        (a chunk if the file is compressed).
+        """
+        if offset == 0:
+            return True
+        with open(self._local_file_path, 'rb') as file:
+            if self._compression:
+                return is_chunk_start(file, offset)
+            file.seek(offset - 1)
+            return file.read(1) == b'\n'
+
+
+    def fingerprint(self, offset):
+        """
+        Hash of the first bytes of the file and of the bytes just before the offset.
+        A file created again or restored from a backup has another fingerprint,
+        even if a line (or a chunk) still starts at the offset.
         """
-        # Open the file in append mode
-        with open(self._local_file_path, 'a') as file:
-            # Append the new total number, serial number and current time/date to the file
-            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            # extent total number to 7 symbols with trailing spaces
-            total_number = str(total_number).ljust(7)
-            serial_number = f"{serial_number:04x}"
-            # extend serial number to 7 symols with trailing spaces
-            serial_number = serial_number.ljust(7)
-            file.write(f"{total_number} {serial_number} {mac} {current_time}\n")
+        with open(self._local_file_path, 'rb') as file:
+            head = file.read(min(offset, LEDGER_FINGERPRINT_SIZE))
+            file.seek(max(0, offset - LEDGER_FINGERPRINT_SIZE))
+            tail = file.read(offset - file.tell())
+        return hashlib.sha256(head + tail).digest()
 
 
     def delete(self):
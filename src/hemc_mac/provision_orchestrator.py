@@ -0,0 +1,197 @@
+import threading
+import time
+import logging
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait
+"""
+ProvisionOrchestrator programs all the boards attached to a station fixture.
+
+The MAC blocks for all the boards are allocated in one RemoteFileProcess
+transaction, then the boards are programmed concurrently on a bounded
+thread pool. Every board gets its own retries and result, the timeout
+applies to every single write attempt and starts when the attempt starts,
+so the boards waiting for a free worker do not use it up.
+MAC blocks of the boards which failed programming, or were never started
+because the run was interrupted (e.g. KeyboardInterrupt), are recorded
+in the file as UNUSED, so they are not lost.
+
+A write which did not finish in time cannot be stopped, it may still
+program the board. Such a board is not retried, its result is TIMEOUT
+and its MAC block is left issued: check the board and release the block
+(RemoteFileProcess.release_atomicaly()) if it was not programmed.
+
+The device is programmed by a DeviceWriter. The writer is pluggable,
+FakeDeviceWriter allows to test the orchestrator without hardware.
+"""
+
+PROVISION_MAX_WORKERS = 8
+PROVISION_DEVICE_TIMEOUT = 30
+PROVISION_DEVICE_RETRIES = 2
+PROVISION_RETRY_DELAY = 1
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+
+class DeviceWriter(ABC):
+    """
+    Base class for the writers which program MAC addresses to a single device.
+    """
+    @abstractmethod
+    def write(self, target, mac_addresses, timeout):
+        """
+        Program the list of MAC addresses to the target device.
+        Must raise an exception on failure and should give up after timeout seconds.
+        """
+
+
+class PrintDeviceWriter(DeviceWriter):
+    """
+    Print the U-Boot variables instead of programming them.
+    """
+    def __init__(self, eth_addr_vars):
+        self._eth_addr_vars = eth_addr_vars
+
+
+    def write(self, target, mac_addresses, timeout):
+        for eth_addr_var, mac in zip(self._eth_addr_vars, mac_addresses):
+            print(f"[{target}] Setting U-Boot variable '{eth_addr_var}' to MAC: {mac}")
+
+
+class FakeDeviceWriter(DeviceWriter):
+    """
+    Fake writer for tests. Remembers the MAC addresses written to every target.
+    failures maps a target to the number of attempts which fail before success,
+    None means that every attempt fails.
+    """
+    def __init__(self, failures=None, delay=0):
+        self._failures = dict(failures or {})
+        self._delay = delay
+        self._lock = threading.Lock()
+        self.written = {}
+
+
+    def write(self, target, mac_addresses, timeout):
+        time.sleep(self._delay)
+        with self._lock:
+            if target in self._failures:
+                left = self._failures[target]
+                if left is None:
+                    raise IOError(f"Failed to program {target}.")
+                if left > 0:
+                    self._failures[target] = left - 1
+                    raise IOError(f"Failed to program {target}, {left} failure(s) left.")
+            self.written[target] = list(mac_addresses)
+
+
+class ProvisionOrchestrator():
+    def __init__(self,
+                 remote_file_process,
+                 writer,
+                 max_workers=PROVISION_MAX_WORKERS,
+                 timeout=PROVISION_DEVICE_TIMEOUT,
+                 retries=PROVISION_DEVICE_RETRIES,
+                 retry_delay=PROVISION_RETRY_DELAY):
+        self._remote_file_process = remote_file_process
+        self._writer = writer
+        self._max_workers = max_workers
+        self._timeout = timeout
+        self._retries = retries
+        self._retry_delay = retry_delay
+
+
+    def run(self, targets):
+        """
+        Allocate MAC blocks for all the targets and program the targets concurrently.
+        Return the list of results in the order of targets, e.g.:
+            {"target": "board1", "result": "OK", "attempts": 1,
+             "mac_addresses": ["60:36:96:10:00:01", ...], "error": None}
+        result is "OK", "FAIL" or "TIMEOUT". The MAC blocks of the "FAIL" boards
+        are recorded as UNUSED. A board with "TIMEOUT" result may still be being
+        programmed, its MAC block stays issued, release it if the board is not programmed.
+        """
+        targets = list(targets)
+        if not targets:
+            return []
+        file_data = self._remote_file_process.process_file_atomicaly(num_of_blocks=len(targets))
+        num_of_macs = len(file_data) // len(targets)
+        blocks = [file_data[i * num_of_macs:(i + 1) * num_of_macs] for i in range(len(targets))]
+
+        executor = ThreadPoolExecutor(max_workers=min(self._max_workers, len(targets)))
+        futures = []
+        try:
+            for target, block in zip(targets, blocks):
+                futures.append(executor.submit(self._program, target, [mac for _, _, mac in block]))
+            # Every attempt is bounded by the timeout, so every board finishes
+            wait(futures)
+        except BaseException:
+            # The boards not started yet are never programmed, the blocks not submitted neither
+            not_started = [block for block, future in zip(blocks, futures) if future.cancel()]
+            not_started.extend(blocks[len(futures):])
+            self._mark_unused([entry for block in not_started for entry in block])
+            raise
+        finally:
+            executor.shutdown(wait=False)
+
+        results = [future.result() for future in futures]
+        self._mark_unused([entry for block, result in zip(blocks, results) if result["result"] == "FAIL"
+                           for entry in block])
+        return results
+
+
+    def _mark_unused(self, file_data):
+        """
+        Record the entries as UNUSED, the error is logged only.
+        """
+        if not file_data:
+            return
+        try:
+            self._remote_file_process.mark_unused_atomicaly(file_data)
+        except Exception as e:
+            logger.error(f"Failed to record {len(file_data)} MAC addresses as UNUSED: {e}")
+
+
+    def _program(self, target, mac_addresses):
+        """
+        Program a single target, retrying on failure.
+        An attempt which did not finish in time is not retried.
+        """
+        error = None
+        for attempt in range(self._retries + 1):
+            try:
+                if not self._write(target, mac_addresses):
+                    logger.error(f"[{target}] Attempt {attempt + 1}: programming did not finish in {self._timeout} seconds.")
+                    return {"target": target, "result": "TIMEOUT", "attempts": attempt + 1,
+                            "mac_addresses": mac_addresses,
+                            "error": f"Programming did not finish in {self._timeout} seconds."}
+                return {"target": target, "result": "OK", "attempts": attempt + 1,
+                        "mac_addresses": mac_addresses, "error": None}
+            except Exception as e:
+                error = e
+                logger.error(f"[{target}] Attempt {attempt + 1}: {e}")
+            if attempt < self._retries:
+                time.sleep(self._retry_delay)
+        return {"target": target, "result": "FAIL", "attempts": self._retries + 1,
+                "mac_addresses": mac_addresses, "error": str(error)}
+
+
+    def _write(self, target, mac_addresses):
+        """
+        Single write attempt limited to timeout seconds.
+        Return False if the write did not finish in time, raise the exception of the writer.
+        """
+        state = {"error": None}
+
+        def write():
+            try:
+                self._writer.write(target, mac_addresses, self._timeout)
+            except Exception as e:
+                state["error"] = e
+
+        thread = threading.Thread(target=write, name=f'hemc_mac-{target}', daemon=True)
+        thread.start()
+        thread.join(self._timeout)
+        if thread.is_alive():
+            return False
+        if state["error"]:
+            raise state["error"]
+        return True
@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+import tempfile
+import logging
+"""
+RemoteFileCache keeps a local copy of the last seen remote file together
+with the remote size and modification time (SFTP stat, FTP SIZE/MDTM).
+
+If the remote size and modification time match the cache, the file is
+not transferred at all. If the remote file just grew (the file is only
+appended to), only the appended part is downloaded. The last cached
+bytes are downloaded again and compared with the cache, so it works
+for the plain and the compressed (gzip chunks) file.
+
+If the server can not tell the size and modification time or can not
+download a part of the file (FTP server without SIZE, MDTM or REST),
+the whole file is transferred and nothing is cached.
+
+The metadata is stored next to the cache in JSON format:
+    /tmp/HEMC_MAC.cache.txt.meta
+    {"remote_file_path": "uploads/HEMC_MAC.txt", "st_size": 1234, "st_mtime": 1754400340}
+"""
+
+PATH_LOCAL_HEMC_MAC_CACHE = '/tmp/HEMC_MAC.cache.txt'
+# The tail is downloaded with this many cached bytes, they must not change
+CACHE_TAIL_OVERLAP = 64
+
+logger = logging.getLogger(__name__.split('.')[0])
+
+
+class RemoteFileCache():
+    def __init__(self, cache_file_path=PATH_LOCAL_HEMC_MAC_CACHE):
+        self._cache_file_path = cache_file_path
+        self._meta_file_path = cache_file_path + '.meta'
+
+
+    def download(self, h_remote, remote_file_path, local_file_path):
+        """
+        Download the remote file to local_file_path, transfer only what is not in the cache.
+        The remote file must not change meanwhile, i.e. the mutex is locked.
+        """
+        try:
+            attrs = h_remote.stat(remote_file_path)
+        except NotImplementedError as e:
+            logger.info(f"{e}, downloading the whole file without the cache.")
+            self.delete()
+            h_remote.get(remote_file_path, local_file_path)
+            return
+        meta = self._read_meta(remote_file_path)
+        if meta and meta['st_size'] == attrs.st_size and meta['st_mtime'] == attrs.st_mtime:
+            shutil.copyfile(self._cache_file_path, local_file_path)
+            logger.info(f"{remote_file_path} is not changed, using the cache.")
+            return
+        if meta and 0 < meta['st_size'] < attrs.st_size:
+            shutil.copyfile(self._cache_file_path, local_file_path)
+            # Download starting from the last cached bytes, they must not be changed
+            offset = max(0, meta['st_size'] - CACHE_TAIL_OVERLAP)
+            with open(local_file_path, 'rb') as f:
+                f.seek(offset)
+                cached_bytes = f.read()
+            try:
+                h_remote.get_tail(remote_file_path, local_file_path, offset)
+                with open(local_file_path, 'rb') as f:
+                    f.seek(offset)
+                    downloaded_bytes = f.read(len(cached_bytes))
+            except NotImplementedError as e:
+                logger.info(f"{e}.")
+                downloaded_bytes = None
+            if downloaded_bytes == cached_bytes and os.path.getsize(local_file_path) == attrs.st_size:
+                logger.info(f"{remote_file_path} grew by {attrs.st_size - meta['st_size']} bytes, downloaded the tail.")
+                self._store(remote_file_path, local_file_path, attrs)
+                return
+            logger.info(f"{remote_file_path} is changed, downloading the whole file.")
+        h_remote.get(remote_file_path, local_file_path)
+        if os.path.getsize(local_file_path) == attrs.st_size:
+            self._store(remote_file_path, local_file_path, attrs)
+
+
+    def upload(self, h_remote, local_file_path, remote_file_path):
+        """
+        Upload local_file_path and remember it as the last seen remote file.
+        """
+        h_remote.put(local_file_path, remote_file_path)
+        try:
+            attrs = h_remote.stat(remote_file_path)
+        except NotImplementedError:
+            self.delete()
+            return
+        self._store(remote_file_path, local_file_path, attrs)
+
+
+    def delete(self):
+        for path in (self._meta_file_path, self._cache_file_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+    def _read_meta(self, remote_file_path):
+        """
+        Return the metadata if it belongs to remote_file_path and matches the cached file.
+        """
+        try:
+            with open(self._meta_file_path, 'r') as f:
+                meta = json.load(f)
+            if meta.get('remote_file_path') != remote_file_path:
+                return None
+            if os.path.getsize(self._cache_file_path) != meta['st_size']:
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        return meta
+
+
+    def _store(self, remote_file_path, local_file_path, attrs):
+        """
+        Replace the cache and the metadata, each of them atomically.
+        """
+        meta = {"remote_file_path": remote_file_path, "st_size": attrs.st_size, "st_mtime": attrs.st_mtime}
+        # Unique temporary files, several transactions may update the cache at the same time
+        cache_dir = os.path.dirname(os.path.abspath(self._cache_file_path))
+        fd, cache_tmp = tempfile.mkstemp(dir=cache_dir)
+        os.close(fd)
+        shutil.copyfile(local_file_path, cache_tmp)
+        os.replace(cache_tmp, self._cache_file_path)
+        fd, meta_tmp = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_tmp, self._meta_file_path)
@@ -1,16 +1,21 @@
 import paramiko
-from .local_file_process import LocalFileProcess, PATH_LOCAL_HEMC_MAC_LIST
+from .local_file_process import LocalFileProcess, PATH_LOCAL_HEMC_MAC_LIST, LEDGER_STATUS_UNUSED, LEDGER_STATUS_RELEASED, LEDGER_STATUS_REUSED
+from .remote_file_cache import RemoteFileCache
+from .allocation_bitmap import AllocationBitmap, FREE_STATUSES
 from .serial_to_mac import SerialToMacAddress, SAPLING_MAC_OUI, SAPLING_HEMC_DEVICE_TYPE, SAPLING_HEMC_NUM_OF_MAC
 import argparse
 import os
+import tempfile
 import time
 import logging
+from contextlib import contextmanager
 
 PATH_REMOTE_HEMC_MAC_LIST = 'uploads/HEMC_MAC.txt'
 PATH_REMOTE_MUTEX_UNLOCKED = 'uploads/mutex.unlocked'
 PATH_REMOTE_MUTEX_LOCKED = 'uploads/mutex.locked'
 PATH_LOCAL_MUTEX_UNLOCKED = '/tmp/mutex.unlocked'
 ATTEMPTS_GET_SERIAL_NUMBER = 5
+LOCK_RETRY_DELAY = 1
 
 logger = logging.getLogger(__name__.split('.')[0])
 
@@ -23,72 +28,335 @@ class RemoteFileProcess():
                  remote_file_path=PATH_REMOTE_HEMC_MAC_LIST,
                  path_remote_mutex_unlocked=PATH_REMOTE_MUTEX_UNLOCKED,
                  path_remote_mutex_locked=PATH_REMOTE_MUTEX_LOCKED,
-                 path_local_mutex_unlocked=PATH_LOCAL_MUTEX_UNLOCKED):
+                 path_local_mutex_unlocked=PATH_LOCAL_MUTEX_UNLOCKED,
+                 cache_file_path=None,
+                 bitmap_file_path=None,
+                 debug_local_files=False,
+                 compression=None):
+        """
+        If cache_file_path is given, the last seen remote file is cached there
+        and the remote file is downloaded only if it has changed.
+        If bitmap_file_path is given, the bitmap of the issued MAC addresses is kept there
+        and the released MAC addresses are issued again, lowest first.
+
+        Every transaction stages the local files in its own temporary directory,
+        removed when the transaction is over, so several transactions can run
+        on the same host at the same time. local_file_path and path_local_mutex_unlocked
+        are used for staging only if debug_local_files is True, the files are kept there.
+        If compression is 'gzip', the MAC list file is stored as gzip chunks
+        (see LocalFileProcess), all the stations must use the same compression.
+        """
 
         self._local_file_path = local_file_path
         self._remote_storage_cls = remote_storage_cls
-        self._local_storage = local_storage_cls(local_file_path=self._local_file_path)
+        self._local_storage_cls = local_storage_cls
+        self._compression = compression
+        self._local_storage = self._new_local_storage(self._local_file_path)
+        self._debug_local_files = debug_local_files
         self._mac_process = mac_process
         self._remote_file_path = remote_file_path
         self._path_remote_mutex_unlocked = path_remote_mutex_unlocked
         self._path_remote_mutex_locked = path_remote_mutex_locked
         self._path_local_mutex_unlocked = path_local_mutex_unlocked
+        self._cache = RemoteFileCache(cache_file_path) if cache_file_path else None
+        self._bitmap = AllocationBitmap(bitmap_file_path) if bitmap_file_path else None
+        self._bitmap_loaded = False
         self.file_data = []
 
 
-    def process_file_atomicaly(self):
+    def process_file_atomicaly(self, num_of_blocks=1):
         """
         Download the file from SFTP server, process it, and upload it back.
         This method ensures that the file is processed atomically by using a separate file as a mutex.
         We assume that the SFTP server supports atomic rename file operation.
+
+        num_of_blocks MAC blocks are allocated in a single transaction, e.g. for all
+        the boards attached to a station fixture. The blocks follow each other in file_data.
+        Released MAC addresses are issued first (REUSED entries) if the bitmap is enabled.
+        """
+        self.file_data = self._process_atomicaly(lambda local_storage: self.allocate(local_storage, num_of_blocks))
+        return self.file_data
+
+
+    def mark_unused_atomicaly(self, file_data):
+        """
+        Record the entries issued earlier as UNUSED, e.g. the MAC block of a board
+        which failed programming. The serial counter is not affected.
+        """
+        self._process_atomicaly(lambda local_storage: self.mark_unused(local_storage, file_data))
+
+
+    def release_atomicaly(self, mac_addresses):
         """
-        h_remote = self._remote_storage_cls.connect()
+        Record the MAC addresses issued earlier as RELEASED, e.g. the MAC addresses
+        of scrapped or RMA'd boards, so they can be issued again.
+        Raise ValueError if a MAC address is not issued.
+        """
+        mac_addresses = self.check_mac_addresses(mac_addresses)
+        self._process_atomicaly(lambda local_storage: self.release(local_storage, mac_addresses))
+
+
+    def compact_atomicaly(self):
+        """
+        Rewrite the compressed file in large chunks, see LocalFileProcess.compact().
+        The other stations download the whole file once afterwards.
+        """
+        self._process_atomicaly(lambda local_storage: local_storage.compact())
+
+
+    @property
+    def remote_file_path(self):
+        return self._remote_file_path
+
+
+    def check_mac_addresses(self, mac_addresses):
+        """
+        Return the MAC addresses in lower case.
+        Raise ValueError if a MAC address does not belong to the OUI and device type.
+        """
+        mac_addresses = [mac.lower() for mac in mac_addresses]
+        for mac in mac_addresses:
+            self._mac_process.mac_to_serial(mac)
+        return mac_addresses
+
+
+    def allocate(self, local_storage, num_of_blocks):
+        """
+        Transaction step: allocate num_of_blocks MAC blocks in the local copy, see transaction().
+        """
+        # At this point we have the local file with the serial number
+        total_number, serial_number, mac = local_storage.read()
+        free_serials = self._free_serials(local_storage, serial_number)
+        entry = (total_number, serial_number, mac)
+        file_data = []
+        for _ in range(num_of_blocks):
+            block = self._mac_process.generate_mac_address_list(*entry, free_serials=free_serials)
+            file_data.extend(block)
+            # Reused serial numbers do not advance the counter
+            entry = (block[-1][0], max([entry[1]] + [serial for _, serial, _ in block]), block[-1][2])
+        local_storage.append([local_storage.format_entry(total, serial, mac, LEDGER_STATUS_REUSED if serial <= serial_number else None)
+                              for total, serial, mac in file_data])
+        return file_data
+
+
+    def mark_unused(self, local_storage, file_data):
+        """
+        Transaction step: record the entries as UNUSED in the local copy, see transaction().
+        """
+        local_storage.append([local_storage.format_entry(total_number, serial_number, mac, LEDGER_STATUS_UNUSED)
+                              for total_number, serial_number, mac in file_data])
+
+
+    def release(self, local_storage, mac_addresses):
+        """
+        Transaction step: record the MAC addresses (see check_mac_addresses()) as RELEASED
+        in the local copy, see transaction().
+        """
+        # One streaming pass to find the entries which issued the MAC addresses
+        issued = {}
+        for total_number, serial_number, mac, status, _ in local_storage.iter_entries():
+            if mac in mac_addresses:
+                issued[mac] = None if status in FREE_STATUSES else (total_number, serial_number, mac)
+        not_issued = [mac for mac in mac_addresses if issued.get(mac) is None]
+        if not_issued:
+            raise ValueError(f"MAC addresses are not issued: {', '.join(not_issued)}.")
+        local_storage.append([local_storage.format_entry(*issued[mac], LEDGER_STATUS_RELEASED)
+                              for mac in mac_addresses])
+
+
+    def _free_serials(self, local_storage, serial_number):
+        """
+        Iterator over the released serial numbers up to serial_number, lowest first.
+        """
+        if not self._bitmap:
+            return None
+        self._update_bitmap(local_storage)
+        base = AllocationBitmap.mac_to_index(self._mac_process.serial_to_mac(0))
+        return (index - base for index in self._bitmap.free_indexes(base + 1, base + serial_number))
+
+
+    def _update_bitmap(self, local_storage):
+        if not self._bitmap_loaded:
+            self._bitmap.load()
+            self._bitmap_loaded = True
+        self._bitmap.update(local_storage)
+
+
+    def read_last_entry(self):
+        """
+        Read-only query: download the file without locking the mutex
+        and return the total number, serial number and MAC address of the last entry.
+        """
+        with self._workspace() as local_file_path:
+            local_storage = self._new_local_storage(local_file_path)
+            h_remote = self.connect()
+            try:
+                self._download(h_remote, local_file_path)
+            finally:
+                self.disconnect(h_remote)
+            return local_storage.read()
+
+
+    def issued_mac_addresses(self, mac_addresses):
+        """
+        Read-only query: download the file without locking the mutex
+        and return the MAC addresses which are issued (not UNUSED or RELEASED).
+        Raise ValueError if a MAC address does not belong to the OUI and device type.
+        """
+        mac_addresses = self.check_mac_addresses(mac_addresses)
+        with self._workspace() as local_file_path:
+            local_storage = self._new_local_storage(local_file_path)
+            h_remote = self.connect()
+            try:
+                self._download(h_remote, local_file_path)
+            finally:
+                self.disconnect(h_remote)
+            if self._bitmap:
+                self._update_bitmap(local_storage)
+                self._bitmap.save()
+                return [mac for mac in mac_addresses if self._bitmap.is_issued(mac)]
+            issued = set()
+            for _, _, mac, status, _ in local_storage.iter_entries():
+                if mac in mac_addresses:
+                    if status in FREE_STATUSES:
+                        issued.discard(mac)
+                    else:
+                        issued.add(mac)
+            return [mac for mac in mac_addresses if mac in issued]
+
+
+    def _new_local_storage(self, local_file_path):
+        return self._local_storage_cls(local_file_path=local_file_path, compression=self._compression)
+
+
+    @contextmanager
+    def _workspace(self, local_path=None):
+        """
+        Yield the local path to stage the file in (local_file_path by default).
+        It is in a private temporary directory, removed on exit,
+        unless debug_local_files is True.
+        """
+        local_path = local_path or self._local_file_path
+        if self._debug_local_files:
+            yield local_path
+            return
+        with tempfile.TemporaryDirectory(prefix='hemc_mac-') as workspace:
+            yield os.path.join(workspace, os.path.basename(local_path))
+
+
+    def _download(self, h_remote, local_file_path):
+        if self._cache:
+            self._cache.download(h_remote, self._remote_file_path, local_file_path)
+        else:
+            h_remote.get(self._remote_file_path, local_file_path)
+
+
+    def _upload(self, h_remote, local_file_path):
+        if self._cache:
+            self._cache.upload(h_remote, local_file_path, self._remote_file_path)
+        else:
+            h_remote.put(local_file_path, self._remote_file_path)
+
+
+    def _process_atomicaly(self, process):
+        """
+        Lock the mutex, download the file, call process(local_storage) to modify the local copy,
+        upload the file back and unlock the mutex. Return the result of process().
+        """
+        h_remote = self.connect()
         exception = None
         # LOCK MUTEX!
         for attempt in range(ATTEMPTS_GET_SERIAL_NUMBER):
             try:
-                h_remote.rename(self._path_remote_mutex_unlocked, self._path_remote_mutex_locked)
-                break
-            except FileNotFoundError as e:
-                logger.error(f"Attempt {attempt + 1}: {e}")
-                if attempt == ATTEMPTS_GET_SERIAL_NUMBER - 1:
-                    logger.error(f"Failed to lock mutex after {ATTEMPTS_GET_SERIAL_NUMBER} attempts.")
-                    raise e
-            logger.error(f"Retrying in 1 second... (Attempt {attempt + 1})")
-            time.sleep(1)
+                if self.try_lock_mutex(h_remote, attempt):
+                    break
+            except FileNotFoundError:
+                self.disconnect(h_remote)
+                raise
+            logger.error(f"Retrying in {LOCK_RETRY_DELAY} second... (Attempt {attempt + 1})")
+            time.sleep(LOCK_RETRY_DELAY)
         # Successfully locked the mutex, now we can proceed
         try:
-            h_remote.get(self._remote_file_path, self._local_file_path)
-            # At this point we have the local file with the serial number
-            entry = self._local_storage.read()
-            self.file_data = self._mac_process.generate_mac_address_list(*entry)
-            for entry in self.file_data:
-                self._local_storage.update(*entry)
-            h_remote.put(self._local_file_path, self._remote_file_path)
+            return self.transaction(h_remote, process)
         except Exception as e:
             exception = e
         finally:
             # Always UNLOCK MUTEX!
-            h_remote.rename(self._path_remote_mutex_locked, self._path_remote_mutex_unlocked)
-            h_remote.close()
-            self._remote_storage_cls.disconnect()
+            self.unlock_mutex(h_remote)
+            self.disconnect(h_remote)
             if exception:
-                logger.error(f"Error while processing {self._local_file_path}: {exception}")
+                logger.error(f"Error while processing {self._remote_file_path}: {exception}")
                 raise exception
-        return self.file_data
+
+
+    def connect(self):
+        """
+        Connect to the remote storage. The *_atomicaly methods run a transaction this way,
+        AsyncRemoteFileProcess runs the same steps on its executor:
+            h_remote = connect()
+            try_lock_mutex(h_remote, attempt) until it returns True
+            transaction(h_remote, process), e.g. process=lambda local_storage: allocate(local_storage, 1)
+            unlock_mutex(h_remote) if locked, then disconnect(h_remote)
+        """
+        return self._remote_storage_cls.connect()
+
+
+    def try_lock_mutex(self, h_remote, attempt):
+        """
+        Single attempt to lock the mutex, return True on success.
+        Raise FileNotFoundError if it is the last attempt.
+        """
+        try:
+            h_remote.rename(self._path_remote_mutex_unlocked, self._path_remote_mutex_locked)
+            return True
+        except FileNotFoundError as e:
+            logger.error(f"Attempt {attempt + 1}: {e}")
+            if attempt == ATTEMPTS_GET_SERIAL_NUMBER - 1:
+                logger.error(f"Failed to lock mutex after {ATTEMPTS_GET_SERIAL_NUMBER} attempts.")
+                raise e
+        return False
+
+
+    def transaction(self, h_remote, process):
+        """
+        Download the file, call process(local_storage) to modify the local copy and upload the file back.
+        Must be called with the mutex locked.
+        """
+        with self._workspace() as local_file_path:
+            local_storage = self._new_local_storage(local_file_path)
+            self._download(h_remote, local_file_path)
+            result = process(local_storage)
+            self._upload(h_remote, local_file_path)
+            if self._bitmap:
+                self._update_bitmap(local_storage)
+                self._bitmap.save()
+        return result
+
+
+    def unlock_mutex(self, h_remote):
+        h_remote.rename(self._path_remote_mutex_locked, self._path_remote_mutex_unlocked)
+
+
+    def disconnect(self, h_remote):
+        h_remote.close()
+        self._remote_storage_cls.disconnect()
 
 
     def cleanup(self):
         """
         Cleanup method to remove all files on SFTP server.
-        Also removes the local mutex file if it exists.
+        Also removes the local files (kept with debug_local_files) if they exist.
         """
         self._local_storage.delete()
+        if self._cache:
+            self._cache.delete()
+        if self._bitmap:
+            self._bitmap.delete()
 
         if os.path.exists(self._path_local_mutex_unlocked):
             os.remove(self._path_local_mutex_unlocked)
 
-        h_remote = self._remote_storage_cls.connect()
+        h_remote = self.connect()
         try:
             h_remote.remove(self._path_remote_mutex_unlocked)
         except FileNotFoundError:
@@ -108,17 +376,20 @@ class RemoteFileProcess():
     def init(self):
         """
         Create mutex on SFTP server.
-        Copy the local file to SFTP server (must be created beforehand).
+        Create the initial MAC list file and copy it to SFTP server.
         """
-        if os.path.exists(self._path_local_mutex_unlocked):
-            os.remove(self._path_local_mutex_unlocked)
-        with open(self._path_local_mutex_unlocked, 'w') as f:
-            f.write("h_remote mutex!\n")
-        h_remote = self._remote_storage_cls.connect()
-        h_remote.put(self._path_local_mutex_unlocked, self._path_remote_mutex_unlocked)
-        mac = self._mac_process.serial_to_mac(0)
-        self._local_storage.create(mac=mac)  # Create the initial MAC list file on local storage
-        h_remote.put(self._local_file_path, self._remote_file_path)
-        h_remote.close()
-        self._remote_storage_cls.disconnect()
-        os.remove(self._path_local_mutex_unlocked)
+        with self._workspace(self._path_local_mutex_unlocked) as path_local_mutex_unlocked, \
+             self._workspace() as local_file_path:
+            if os.path.exists(path_local_mutex_unlocked):
+                os.remove(path_local_mutex_unlocked)
+            with open(path_local_mutex_unlocked, 'w') as f:
+                f.write("h_remote mutex!\n")
+            h_remote = self.connect()
+            h_remote.put(path_local_mutex_unlocked, self._path_remote_mutex_unlocked)
+            mac = self._mac_process.serial_to_mac(0)
+            # Create the initial MAC list file on local storage
+            self._new_local_storage(local_file_path).create(mac=mac)
+            self._upload(h_remote, local_file_path)
+            h_remote.close()
+            self._remote_storage_cls.disconnect()
+            os.remove(path_local_mutex_unlocked)
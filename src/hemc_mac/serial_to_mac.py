@@ -32,17 +32,33 @@ class SerialToMacAddress():
         return mac
 
 
-    def generate_mac_address_list(self, total_number, serial_number, mac="00:00:00:00:00:00"):
+    def mac_to_serial(self, mac):
+        """
+        Get the serial number from the MAC address generated by serial_to_mac().
+        """
+        words = mac.lower().split(':')
+        if len(words) != 6 or ':'.join(words[:4]) != f"{self._oui}:{self._device_type}".lower():
+            raise ValueError(f"MAC address {mac} does not belong to {self._oui}:{self._device_type}.")
+        return int(words[4] + words[5], 16)
+
+
+    def generate_mac_address_list(self, total_number, serial_number, mac="00:00:00:00:00:00", free_serials=None):
         """
         Generate a MAC address based on the serial number.
+        If free_serials iterator is given, the free (released) serial numbers are taken
+        from it first, then the serial number is incremented.
         """
         file_data = []
+        free_serials = free_serials if free_serials is not None else iter(())
         # print(f"self._num_of_macs: {self._num_of_macs}")
         for _ in range(self._num_of_macs):
             total_number += 1
-            serial_number += 1
-            mac = self.serial_to_mac(serial_number)
-            file_data.append((total_number, serial_number, mac))
+            free_serial = next(free_serials, None)
+            if free_serial is None:
+                serial_number += 1
+                free_serial = serial_number
+            mac = self.serial_to_mac(free_serial)
+            file_data.append((total_number, free_serial, mac))
         """
         ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
         TODO: Add functionality to set Ethernet MAC address on the devices.
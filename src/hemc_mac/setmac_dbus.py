@@ -6,7 +6,11 @@ from .local_file_process import LocalFileProcess, PATH_LOCAL_HEMC_MAC_LIST
 from .remote_file_process import RemoteFileProcess, PATH_REMOTE_HEMC_MAC_LIST, PATH_REMOTE_MUTEX_UNLOCKED, PATH_REMOTE_MUTEX_LOCKED, PATH_LOCAL_MUTEX_UNLOCKED
 from saplinguboot import UBootEnv, SAPLING_ETH_MAC_ADDR_VARS, SAPLING_ETH_MAC_ADDR_DEFAULT
 from .sftp_client import SftpClient
+from .remote_file_cache import PATH_LOCAL_HEMC_MAC_CACHE
+from .allocation_bitmap import PATH_LOCAL_HEMC_MAC_BITMAP
 from .ftp_client import FtpClient
+from .hemcd_client import HemcdClient, HemcdFileProcess
+from .allocation_server import HEMCD_PORT
 
 import logging
 
@@ -73,11 +77,25 @@ string:"$(cat << 'EOF'
 }
 EOF
 )"
+        The MAC addresses are checked against the current MAC list file, the configuration
+        of the server is the same as for set_mac_addresses_ftp().
+        An issued MAC address is rejected unless "force": true is given, if the MAC list file
+        can not be read, the MAC addresses are not set either.
         """
         mac_all = []
         try:
             config = json.loads(config)
             mac_all = config.get('mac_addresses', [])
+            if not config.get('force', False):
+                serial_to_mac_address = SerialToMacAddress(
+                                        oui = config.get('oui', SAPLING_MAC_OUI),
+                                        device_type = config.get('device_type', SAPLING_HEMC_DEVICE_TYPE))
+                # MAC addresses of other vendors or device types are never issued by us
+                own_macs = [mac for mac in mac_all if self._is_own_mac(serial_to_mac_address, mac)]
+                # Fails if the MAC list file can not be read, the MAC addresses are not set then
+                issued = self._remote_file_process(config).issued_mac_addresses(own_macs) if own_macs else []
+                if issued:
+                    raise ValueError(f"MAC addresses are already issued: {', '.join(issued)}.")
             for i, eth_addr_var in enumerate(SAPLING_ETH_MAC_ADDR_VARS):
                     mac = mac_all[i]
                     logger.info(f"Setting U-Boot variable '{eth_addr_var}' to MAC: {mac}")
@@ -90,6 +108,73 @@ EOF
         return json.dumps(ret)
 
 
+    def _remote_file_process(self, config):
+        """
+        Create the RemoteFileProcess (HemcdFileProcess for "protocol": "hemcd") from the JSON configuration.
+        """
+        remote_storage_cls = config.get('protocol', 'sftp').lower()
+        if remote_storage_cls == 'sftp':
+            remote_storage_cls = SftpClient
+        elif remote_storage_cls == 'ftp':
+            remote_storage_cls = FtpClient
+        elif remote_storage_cls == 'hemcd':
+            remote_storage_cls = HemcdClient
+        else:
+            logger.error(f"Unsupported FTP client: {remote_storage_cls}. Supported clients are 'sftp', 'ftp' and 'hemcd'.")
+            raise ValueError(f"Unsupported FTP client: {remote_storage_cls}. Supported clients are 'sftp', 'ftp' and 'hemcd'.")
+
+        remote_storage_kwargs = {}
+        if remote_storage_cls is SftpClient:
+            # JSON true/false, or the same strings as in the credentials file
+            remote_storage_kwargs['compress'] = str(config.get('ssh_compression', False)).lower() in ('yes', 'true', '1')
+        if remote_storage_cls is HemcdClient:
+            # The allocation server has its own port and no default secret
+            remote_storage_cls.init(
+                    server=config.get('server', '192.168.1.102'),
+                    password=config.get('password'),
+                    port=int(config.get('port', HEMCD_PORT)),
+                    timeout=int(config.get('timeout', 10)))
+        else:
+            remote_storage_cls.init(
+                    server=config.get('server', '192.168.1.102'),
+                    name=config.get('name', 'sftp_hemc'),
+                    password=config.get('password', 'SaplingHemc'),
+                    port=int(config.get('port', 22)),
+                    timeout=int(config.get('timeout', 10)),
+                    **remote_storage_kwargs)
+
+        serial_to_mac_address = SerialToMacAddress(
+                                oui = config.get('oui', SAPLING_MAC_OUI),
+                                device_type = config.get('device_type', SAPLING_HEMC_DEVICE_TYPE),
+                                num_of_macs= len(SAPLING_ETH_MAC_ADDR_VARS))
+
+        if remote_storage_cls is HemcdClient:
+            return HemcdFileProcess(remote_storage_cls=remote_storage_cls)
+        else:
+            return RemoteFileProcess(
+                                    local_file_path=config.get('path_local_hemc_mac_list', PATH_LOCAL_HEMC_MAC_LIST),
+                                    remote_file_path=config.get('path_remote_hemc_mac_list', PATH_REMOTE_HEMC_MAC_LIST),
+                                    path_remote_mutex_unlocked=config.get('path_remote_mutex_unlocked', PATH_REMOTE_MUTEX_UNLOCKED),
+                                    path_remote_mutex_locked=config.get('path_remote_mutex_locked', PATH_REMOTE_MUTEX_LOCKED),
+                                    path_local_mutex_unlocked=config.get('path_local_mutex_unlocked', PATH_LOCAL_MUTEX_UNLOCKED),
+                                    local_storage_cls = LocalFileProcess,
+                                    remote_storage_cls=remote_storage_cls,
+                                    mac_process=serial_to_mac_address,
+                                    cache_file_path=config.get('path_local_hemc_mac_cache', PATH_LOCAL_HEMC_MAC_CACHE),
+                                    bitmap_file_path=config.get('path_local_hemc_mac_bitmap', PATH_LOCAL_HEMC_MAC_BITMAP),
+                                    debug_local_files=config.get('debug_local_files', False),
+                                    compression=config.get('ledger_compression'))
+
+
+    @staticmethod
+    def _is_own_mac(serial_to_mac_address, mac):
+        try:
+            serial_to_mac_address.mac_to_serial(mac)
+        except ValueError:
+            return False
+        return True
+
+
     @dbus.service.method("com.sapling.hemc.setmac", in_signature='s', out_signature='s')
     def set_mac_addresses_ftp(self, config):
         """
@@ -117,6 +202,11 @@ string:"$(cat << 'EOF'
 "path_remote_mutex_unlocked": "uploads/mutex.unlocked",
 "path_remote_mutex_locked": "uploads/mutex.locked",
 "path_local_mutex_unlocked": "/tmp/mutex.unlocked",
+"path_local_hemc_mac_cache": "/tmp/HEMC_MAC.cache.txt",
+"path_local_hemc_mac_bitmap": "/tmp/HEMC_MAC.bitmap",
+"debug_local_files": false,
+"ssh_compression": false,
+"ledger_compression": null,
 "protocol": "sftp",
 "port": 22,
 "timeout": 10,
@@ -142,47 +232,34 @@ string:"$(cat << 'EOF'
 "path_remote_mutex_unlocked": "tmp/mutex.unlocked",
 "path_remote_mutex_locked": "tmp/mutex.locked",
 "path_local_mutex_unlocked": "/tmp/mutex.unlocked",
+"path_local_hemc_mac_cache": "/tmp/HEMC_MAC.cache.txt",
+"path_local_hemc_mac_bitmap": "/tmp/HEMC_MAC.bitmap",
+"debug_local_files": false,
+"ledger_compression": null,
 "oui": "60:36:96",
 "device_type": "10"
 }
 EOF
 )"
+
+"ssh_compression": true (or "yes") negotiates the SSH transport with compression (sftp only),
+"ledger_compression": "gzip" stores the MAC list file as gzip chunks.
+
+The allocation server ('python -m hemc_mac serve') is used with "protocol": "hemcd",
+"server" is the host name or the Unix socket path of the server, "port" defaults to 5021,
+"password" is its shared secret (required for TCP, there is no default):
+
+dbus-send --system --print-reply --dest=com.sapling.hemc \
+/com/sapling/hemc/setmac \
+com.sapling.hemc.setmac.set_mac_addresses_ftp \
+string:'{"protocol": "hemcd", "server": "/run/hemcd.sock"}'
         """
         ret = "FAIL"
         mac_all = []
         try:
             config = json.loads(config)
 
-            remote_storage_cls = config.get('protocol', 'sftp').lower()
-            if remote_storage_cls == 'sftp':
-                remote_storage_cls = SftpClient
-            elif remote_storage_cls == 'ftp':
-                remote_storage_cls = FtpClient
-            else:
-                logger.error(f"Unsupported FTP client: {remote_storage_cls}. Supported clients are 'sftp' and 'ftp'.")
-                raise ValueError(f"Unsupported FTP client: {remote_storage_cls}. Supported clients are 'sftp' and 'ftp'.")
-
-            remote_storage_cls.init(
-                    server=config.get('server', '192.168.1.102'),
-                    name=config.get('name', 'sftp_hemc'),
-                    password=config.get('password', 'SaplingHemc'),
-                    port=int(config.get('port', 22)),
-                    timeout=int(config.get('timeout', 10)))
-
-            serial_to_mac_address = SerialToMacAddress(
-                                    oui = config.get('oui', SAPLING_MAC_OUI),
-                                    device_type = config.get('device_type', SAPLING_HEMC_DEVICE_TYPE),
-                                    num_of_macs= len(SAPLING_ETH_MAC_ADDR_VARS))
-
-            remote_file_process = RemoteFileProcess(
-                                    local_file_path=config.get('path_local_hemc_mac_list', PATH_LOCAL_HEMC_MAC_LIST),
-                                    remote_file_path=config.get('path_remote_hemc_mac_list', PATH_REMOTE_HEMC_MAC_LIST),
-                                    path_remote_mutex_unlocked=config.get('path_remote_mutex_unlocked', PATH_REMOTE_MUTEX_UNLOCKED),
-                                    path_remote_mutex_locked=config.get('path_remote_mutex_locked', PATH_REMOTE_MUTEX_LOCKED),
-                                    path_local_mutex_unlocked=config.get('path_local_mutex_unlocked', PATH_LOCAL_MUTEX_UNLOCKED),
-                                    local_storage_cls = LocalFileProcess,
-                                    remote_storage_cls=remote_storage_cls,
-                                    mac_process=serial_to_mac_address)
+            remote_file_process = self._remote_file_process(config)
 
             file_data = remote_file_process.process_file_atomicaly()
             for i, eth_addr_var in enumerate(SAPLING_ETH_MAC_ADDR_VARS):
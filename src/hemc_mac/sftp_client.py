@@ -1,12 +1,39 @@
 import paramiko
+import shutil
+
+
+class SaplingSFTP(paramiko.SFTPClient):
+    _ssh_client = None
+
+    def close(self):
+        """
+        Close the SFTP session together with its SSH connection.
+        """
+        super().close()
+        if self._ssh_client:
+            self._ssh_client.close()
+            self._ssh_client = None
+
+
+    def get_tail(self, sftp_path, local_path, offset):
+        """
+        Download the part of the file starting at offset.
+        The local file is truncated to offset and the downloaded part is appended.
+        """
+        with self.open(sftp_path, 'rb') as remote_file, open(local_path, 'r+b') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            remote_file.seek(offset)
+            shutil.copyfileobj(remote_file, f)
+
 
 class SftpClient():
-    _transport = None
     _sftp_server = None
     _sftp_name = None
     _sftp_password = None
     _timeout = None
     _port = None
+    _compress = False
 
     @classmethod
     def init(cls,
@@ -14,29 +41,43 @@ class SftpClient():
                  name,
                  password,
                  port=22,
-                 timeout=2):
+                 timeout=2,
+                 compress=False):
+        """
+        If compress is True, the SSH transport is negotiated with zlib compression.
+        """
         cls._sftp_server = server
         cls._sftp_name = name
         cls._sftp_password = password
         cls._timeout = timeout
         cls._port = port
+        cls._compress = compress
+
+    @classmethod
+    def new(cls, **kwargs):
+        """
+        Return a subclass configured for one more server,
+        so that several servers can be used at the same time.
+        """
+        client_cls = type(cls.__name__, (cls,), {})
+        client_cls.init(**kwargs)
+        return client_cls
 
     @classmethod
     def connect(cls):
-        cls._transport = paramiko.SSHClient()
-        cls._transport.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        cls._transport.connect(cls._sftp_server,
+        # Every connection has its own SSH client, it is closed together with the SFTP handle
+        ssh_client = paramiko.SSHClient()
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh_client.connect(cls._sftp_server,
                     username=cls._sftp_name,
                     password=cls._sftp_password,
                     port=cls._port,
-                    timeout=cls._timeout)
-        sftp = cls._transport.open_sftp()
+                    timeout=cls._timeout,
+                    compress=cls._compress)
+        sftp = SaplingSFTP.from_transport(ssh_client.get_transport())
+        sftp._ssh_client = ssh_client
         return sftp
 
     @classmethod
     def disconnect(cls):
-        if cls._transport:
-            cls._transport.close()
-            cls._transport = None
-
-
+        pass
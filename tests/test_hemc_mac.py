@@ -1,15 +1,27 @@
+import asyncio
+import gzip
 import threading
 import os
+import shutil
 import sys
+import tempfile
+import time
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import logging
 from dataclasses import dataclass, field
 
 # Force insert the path to the beginning of sys.path
 # to use the local package instead of the installed package.
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
-from hemc_mac import SerialToMacAddress
+from hemc_mac import SerialToMacAddress, LocalFileProcess, RemoteFileProcess
+from hemc_mac import ProvisionOrchestrator, FakeDeviceWriter
+from hemc_mac import AllocationServer, HemcdClient, HemcdFileProcess
+from hemc_mac.allocation_server import HEMCD_MAX_NUM_OF_BLOCKS
+from hemc_mac.ftp_client import SaplingFTP
+from ftplib import error_perm
+from hemc_mac import AllocationBitmap
+from hemc_mac import AsyncRemoteFileProcess
 
 """
 To run this test, run the following commands:
@@ -47,6 +59,529 @@ class TestHemcMac(unittest.TestCase):
             self.assertEqual(file_data, expected_data)
             # print(file_data)
 
+
+class LocalDirClient():
+    """
+    Remote storage backed by a local directory, used instead of SFTP/FTP server.
+    """
+    _root = None
+    transfers = []
+
+    @classmethod
+    def init(cls, root):
+        cls._root = root
+        cls.transfers = []
+
+    @classmethod
+    def connect(cls):
+        return cls()
+
+    @classmethod
+    def disconnect(cls):
+        pass
+
+    def _path(self, remote_path):
+        return os.path.join(self._root, remote_path)
+
+    def get(self, remote_path, local_path):
+        if not os.path.exists(self._path(remote_path)):
+            raise FileNotFoundError(remote_path)
+        self.transfers.append(('get', remote_path))
+        shutil.copyfile(self._path(remote_path), local_path)
+
+    def get_tail(self, remote_path, local_path, offset):
+        self.transfers.append(('get_tail', remote_path))
+        with open(self._path(remote_path), 'rb') as remote_file, open(local_path, 'r+b') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            remote_file.seek(offset)
+            f.write(remote_file.read())
+
+    def stat(self, remote_path):
+        return os.stat(self._path(remote_path))
+
+    def put(self, local_path, remote_path):
+        shutil.copyfile(local_path, self._path(remote_path))
+
+    def rename(self, old_path, new_path):
+        if not os.path.exists(self._path(old_path)):
+            raise FileNotFoundError(old_path)
+        os.rename(self._path(old_path), self._path(new_path))
+
+    def remove(self, remote_path):
+        if not os.path.exists(self._path(remote_path)):
+            raise FileNotFoundError(remote_path)
+        os.remove(self._path(remote_path))
+
+    def close(self):
+        pass
+
+
+class NoStatLocalDirClient(LocalDirClient):
+    """
+    Like an FTP server without SIZE/MDTM (RFC 3659).
+    """
+    def stat(self, remote_path):
+        raise NotImplementedError("FTP server does not support SIZE/MDTM")
+
+
+def new_remote_file_process(tmp_dir, name, remote_storage_cls=LocalDirClient, **kwargs):
+    """
+    RemoteFileProcess of a station staging its files in tmp_dir, 2 MAC addresses per block.
+    The remote files are in the directory of remote_storage_cls.
+    """
+    return RemoteFileProcess(
+                            local_file_path=os.path.join(tmp_dir, f'{name}.txt'),
+                            remote_file_path='HEMC_MAC.txt',
+                            path_remote_mutex_unlocked='mutex.unlocked',
+                            path_remote_mutex_locked='mutex.locked',
+                            path_local_mutex_unlocked=os.path.join(tmp_dir, f'{name}.mutex'),
+                            local_storage_cls=LocalFileProcess,
+                            remote_storage_cls=remote_storage_cls,
+                            mac_process=SerialToMacAddress(oui="60:36:96", device_type="10", num_of_macs=2),
+                            **kwargs)
+
+
+class RemoteDirTestCase(unittest.TestCase):
+    """
+    The MAC list file is initialized in a local directory used as the remote storage.
+    """
+    compression = None
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._remote_dir = os.path.join(self._tmp.name, 'remote')
+        os.mkdir(self._remote_dir)
+        LocalDirClient.init(self._remote_dir)
+        self._remote_file_process = self._station('HEMC_MAC')
+        self._remote_file_process.init()
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _station(self, name, remote_storage_cls=LocalDirClient, **kwargs):
+        return new_remote_file_process(self._tmp.name, name, remote_storage_cls, compression=self.compression, **kwargs)
+
+    def _remote_lines(self):
+        with open(os.path.join(self._remote_dir, 'HEMC_MAC.txt')) as f:
+            return [line.split() for line in f.readlines()[1:]]
+
+
+class TestProvisionOrchestrator(RemoteDirTestCase):
+    def test_all_devices_programmed(self):
+        writer = FakeDeviceWriter()
+        orchestrator = ProvisionOrchestrator(self._remote_file_process, writer, retry_delay=0)
+        results = orchestrator.run(['board1', 'board2', 'board3'])
+        self.assertEqual([result['result'] for result in results], ['OK', 'OK', 'OK'])
+        self.assertEqual(writer.written['board1'], ['60:36:96:10:00:01', '60:36:96:10:00:02'])
+        self.assertEqual(writer.written['board3'], ['60:36:96:10:00:05', '60:36:96:10:00:06'])
+        # The initial entry and 3 blocks of 2 MAC addresses
+        self.assertEqual(len(self._remote_lines()), 7)
+
+    def test_failed_device_recorded_as_unused(self):
+        writer = FakeDeviceWriter(failures={'board1': 1, 'board2': None})
+        orchestrator = ProvisionOrchestrator(self._remote_file_process, writer, retries=1, retry_delay=0)
+        results = orchestrator.run(['board1', 'board2'])
+        self.assertEqual(results[0]['result'], 'OK')
+        self.assertEqual(results[0]['attempts'], 2)
+        self.assertEqual(results[1]['result'], 'FAIL')
+        unused = [words[2] for words in self._remote_lines() if words[-1] == 'UNUSED']
+        self.assertEqual(unused, ['60:36:96:10:00:03', '60:36:96:10:00:04'])
+        # The older clients take the counter from the last line
+        self.assertEqual(self._remote_lines()[-1][:3] + self._remote_lines()[-1][5:], ['4', '0004', '60:36:96:10:00:04', 'COUNTER'])
+        # UNUSED entries do not move the serial counter back
+        file_data = self._remote_file_process.process_file_atomicaly()
+        self.assertEqual(file_data[0], (5, 5, '60:36:96:10:00:05'))
+
+    def test_fewer_workers_than_targets(self):
+        # The timeout starts with the attempt, the boards waiting for the worker do not time out
+        writer = FakeDeviceWriter(delay=0.2)
+        orchestrator = ProvisionOrchestrator(self._remote_file_process, writer, max_workers=1, timeout=0.5, retry_delay=0)
+        results = orchestrator.run(['board1', 'board2', 'board3'])
+        self.assertEqual([result['result'] for result in results], ['OK', 'OK', 'OK'])
+        self.assertEqual(sorted(writer.written), ['board1', 'board2', 'board3'])
+
+    def test_interrupted_run(self):
+        # The boards not started yet are recorded as UNUSED, the interrupt is propagated
+        writer = FakeDeviceWriter(delay=0.2)
+        orchestrator = ProvisionOrchestrator(self._remote_file_process, writer, max_workers=1, retry_delay=0)
+        def interrupt(futures):
+            while not futures[0].running():
+                time.sleep(0.01)
+            raise KeyboardInterrupt
+        with patch('hemc_mac.provision_orchestrator.wait', side_effect=interrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                orchestrator.run(['board1', 'board2', 'board3'])
+        unused = [words[2] for words in self._remote_lines() if words[-1] == 'UNUSED']
+        self.assertEqual(unused, ['60:36:96:10:00:03', '60:36:96:10:00:04', '60:36:96:10:00:05', '60:36:96:10:00:06'])
+
+    def test_timeout_not_retried(self):
+        writer = FakeDeviceWriter(failures={'board2': None}, delay=0.3)
+        orchestrator = ProvisionOrchestrator(self._remote_file_process, writer, max_workers=1, timeout=0.1, retry_delay=0)
+        results = orchestrator.run(['board1', 'board2'])
+        self.assertEqual([(result['result'], result['attempts']) for result in results], [('TIMEOUT', 1), ('TIMEOUT', 1)])
+        # The timed out writes may still program the boards, their blocks stay issued
+        self.assertEqual([words for words in self._remote_lines() if words[-1] == 'UNUSED'], [])
+
+
+class TestRemoteFileCache(RemoteDirTestCase):
+    def test_download_cache(self):
+        station1 = self._station('station1', cache_file_path=os.path.join(self._tmp.name, 'station1.cache'))
+        station2 = self._station('station2')
+        station1.process_file_atomicaly()
+        LocalDirClient.transfers = []
+        # Nothing changed remotely: no transfer
+        station1.process_file_atomicaly()
+        self.assertEqual(station1.read_last_entry(), (4, 4, '60:36:96:10:00:04'))
+        self.assertEqual(LocalDirClient.transfers, [])
+        # Another station appended to the file: only the tail is transferred
+        station2.process_file_atomicaly()
+        LocalDirClient.transfers = []
+        file_data = station1.process_file_atomicaly()
+        self.assertEqual(file_data[0], (7, 7, '60:36:96:10:00:07'))
+        self.assertEqual(LocalDirClient.transfers, [('get_tail', 'HEMC_MAC.txt')])
+        with open(os.path.join(self._remote_dir, 'HEMC_MAC.txt')) as remote, open(os.path.join(self._tmp.name, 'station1.cache')) as cache:
+            self.assertEqual(remote.read(), cache.read())
+
+    def test_cache_without_stat(self):
+        cache_file_path = os.path.join(self._tmp.name, 'station1.cache')
+        station1 = self._station('station1', NoStatLocalDirClient, cache_file_path=cache_file_path)
+        station1.process_file_atomicaly()
+        LocalDirClient.transfers = []
+        self.assertEqual(station1.process_file_atomicaly()[0], (3, 3, '60:36:96:10:00:03'))
+        self.assertEqual(LocalDirClient.transfers, [('get', 'HEMC_MAC.txt')])
+        self.assertFalse(os.path.exists(cache_file_path))
+
+    def test_ftp_stat_unsupported(self):
+        ftp = SaplingFTP()
+        with patch.object(ftp, 'voidcmd', side_effect=error_perm('502 Command not implemented.')):
+            with self.assertRaises(NotImplementedError):
+                ftp.stat('HEMC_MAC.txt')
+        with patch.object(ftp, 'voidcmd', side_effect=error_perm('550 No such file.')):
+            with self.assertRaises(FileNotFoundError):
+                ftp.stat('HEMC_MAC.txt')
+
+
+class TestConcurrentTransactions(RemoteDirTestCase):
+    @patch('hemc_mac.remote_file_process.LOCK_RETRY_DELAY', 0.01)
+    @patch('hemc_mac.remote_file_process.ATTEMPTS_GET_SERIAL_NUMBER', 1000)
+    def test_concurrent_allocations_on_one_host(self):
+        macs = []
+        def allocate():
+            station = self._station('station', cache_file_path=os.path.join(self._tmp.name, 'station.cache'))
+            for _ in range(3):
+                macs.extend(mac for _, _, mac in station.process_file_atomicaly())
+        threads = [threading.Thread(target=allocate) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(macs), 24)
+        self.assertEqual(len(set(macs)), 24)
+        self.assertEqual(len(self._remote_lines()), 25)
+        # Nothing is staged in the configured local path
+        self.assertFalse(os.path.exists(os.path.join(self._tmp.name, 'station.txt')))
+
+
+class TestAllocationBitmap(RemoteDirTestCase):
+    def test_release_and_reuse(self):
+        bitmap_file_path = os.path.join(self._tmp.name, 'HEMC_MAC.bitmap')
+        station = self._station('station', bitmap_file_path=bitmap_file_path)
+        station.process_file_atomicaly(num_of_blocks=3)
+        with self.assertRaises(ValueError):
+            station.release_atomicaly(['60:36:96:10:00:07'])
+        station.release_atomicaly(['60:36:96:10:00:05', '60:36:96:10:00:02'])
+        bitmap = AllocationBitmap(bitmap_file_path)
+        self.assertTrue(bitmap.load())
+        self.assertFalse(bitmap.is_issued('60:36:96:10:00:02'))
+        self.assertTrue(bitmap.is_issued('60:36:96:10:00:03'))
+        # Released serials are issued again lowest first, then the counter continues
+        # Another station without the bitmap sees the current file
+        other = self._station('other')
+        self.assertEqual(other.issued_mac_addresses(['60:36:96:10:00:02', '60:36:96:10:00:03']), ['60:36:96:10:00:03'])
+        file_data = station.process_file_atomicaly(num_of_blocks=2)
+        self.assertEqual(file_data, [(7, 2, '60:36:96:10:00:02'), (8, 5, '60:36:96:10:00:05'),
+                                     (9, 7, '60:36:96:10:00:07'), (10, 8, '60:36:96:10:00:08')])
+        statuses = [words[5] if len(words) > 5 else None for words in self._remote_lines()[-4:]]
+        self.assertEqual(statuses, ['REUSED', 'REUSED', None, None])
+        self.assertEqual(station.process_file_atomicaly()[0], (11, 9, '60:36:96:10:00:09'))
+
+    def test_restored_ledger(self):
+        # The file restored from a backup continues at the offset of the bitmap with other entries
+        station = self._station('station', bitmap_file_path=os.path.join(self._tmp.name, 'HEMC_MAC.bitmap'))
+        other = self._station('other')
+        station.process_file_atomicaly()
+        remote_file_path = os.path.join(self._remote_dir, 'HEMC_MAC.txt')
+        shutil.copy(remote_file_path, os.path.join(self._tmp.name, 'backup'))
+        station.process_file_atomicaly()
+        station.release_atomicaly(['60:36:96:10:00:03'])
+        shutil.copy(os.path.join(self._tmp.name, 'backup'), remote_file_path)
+        other.process_file_atomicaly()
+        other.release_atomicaly(['60:36:96:10:00:04'])
+        # 60:36:96:10:00:03 is issued in the restored file, the bitmap is rebuilt
+        file_data = station.process_file_atomicaly()
+        self.assertEqual(file_data, [(5, 4, '60:36:96:10:00:04'), (6, 5, '60:36:96:10:00:05')])
+
+    def test_bitmap_rebuild(self):
+        local_storage = LocalFileProcess(os.path.join(self._tmp.name, 'station.txt'))
+        mac_process = SerialToMacAddress(oui="60:36:96", device_type="10", num_of_macs=4)
+        local_storage.create(mac=mac_process.serial_to_mac(0))
+        for entry in mac_process.generate_mac_address_list(0, 0):
+            local_storage.update(*entry)
+        local_storage.update(3, 3, '60:36:96:10:00:03', 'RELEASED')
+        bitmap = AllocationBitmap(os.path.join(self._tmp.name, 'station.bitmap'))
+        bitmap.rebuild(local_storage)
+        base = AllocationBitmap.mac_to_index('60:36:96:10:00:00')
+        self.assertEqual(list(bitmap.free_indexes(base, base + 6)), [base + 3, base + 5, base + 6])
+
+
+class TestGzipChunks(RemoteDirTestCase):
+    compression = 'gzip'
+
+    def test_gzip_chunks(self):
+        station1 = self._station('station1', cache_file_path=os.path.join(self._tmp.name, 'station1.cache'),
+                                 bitmap_file_path=os.path.join(self._tmp.name, 'station1.bitmap'))
+        station2 = self._station('station2')
+        station1.process_file_atomicaly(num_of_blocks=2)
+        station2.process_file_atomicaly()
+        LocalDirClient.transfers = []
+        station1.release_atomicaly(['60:36:96:10:00:02'])
+        # The file is gzip compressed, only the tail is transferred
+        self.assertEqual(LocalDirClient.transfers, [('get_tail', 'HEMC_MAC.txt')])
+        with open(os.path.join(self._remote_dir, 'HEMC_MAC.txt'), 'rb') as f:
+            lines = gzip.decompress(f.read()).decode().splitlines()
+        self.assertEqual(len(lines), 10)
+        self.assertTrue(lines[-2].endswith('RELEASED'))
+        self.assertTrue(lines[-1].endswith('COUNTER'))
+        self.assertEqual(station2.read_last_entry(), (6, 6, '60:36:96:10:00:06'))
+        self.assertEqual(station1.process_file_atomicaly()[0], (7, 2, '60:36:96:10:00:02'))
+        # Compaction keeps the lines and the bitmap, only the chunks are merged
+        size = os.path.getsize(os.path.join(self._remote_dir, 'HEMC_MAC.txt'))
+        station1.compact_atomicaly()
+        with open(os.path.join(self._remote_dir, 'HEMC_MAC.txt'), 'rb') as f:
+            data = f.read()
+        self.assertLess(len(data), size)
+        self.assertEqual(gzip.decompress(data).decode().splitlines()[:10], lines)
+        self.assertEqual(station2.process_file_atomicaly()[0], (9, 8, '60:36:96:10:00:08'))
+        self.assertEqual(station1.process_file_atomicaly()[0], (11, 10, '60:36:96:10:00:0a'))
+
+    test_restored_ledger = TestAllocationBitmap.test_restored_ledger
+
+
+class TestAllocationServer(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._local_file_path = os.path.join(self._tmp.name, 'HEMC_MAC.txt')
+        self._journal_path = os.path.join(self._tmp.name, 'HEMC_MAC.journal')
+        self._bitmap_file_path = os.path.join(self._tmp.name, 'HEMC_MAC.bitmap')
+        self._socket_path = os.path.join(self._tmp.name, 'hemcd.sock')
+        self._mac_process = SerialToMacAddress(oui="60:36:96", device_type="10", num_of_macs=2)
+        HemcdClient.init(server=self._socket_path)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _start_server(self, server_address=None, secret=None):
+        server = AllocationServer(mac_process=self._mac_process,
+                                  server=server_address or self._socket_path,
+                                  port=0,
+                                  local_file_path=self._local_file_path,
+                                  journal_path=self._journal_path,
+                                  bitmap_file_path=self._bitmap_file_path,
+                                  secret=secret)
+        server.start()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        return server, thread
+
+    def test_concurrent_allocations(self):
+        server, thread = self._start_server()
+        try:
+            server.init()
+            macs = []
+            def allocate():
+                file_data = HemcdFileProcess().process_file_atomicaly(num_of_blocks=2)
+                macs.extend(mac for _, _, mac in file_data)
+            threads = [threading.Thread(target=allocate) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            server.shutdown()
+            thread.join()
+        self.assertEqual(len(macs), 32)
+        self.assertEqual(len(set(macs)), 32)
+        self.assertEqual(LocalFileProcess(self._local_file_path).read(), (32, 32, '60:36:96:10:00:20'))
+        self.assertFalse(os.path.exists(self._journal_path))
+
+    def test_release_and_reuse(self):
+        server, thread = self._start_server()
+        try:
+            server.init()
+            client = HemcdFileProcess()
+            client.process_file_atomicaly(num_of_blocks=2)
+            client.release_atomicaly(['60:36:96:10:00:03'])
+            # Same lower 24 bits, other vendor
+            with self.assertRaisesRegex(RuntimeError, 'does not belong'):
+                client.release_atomicaly(['aa:bb:cc:10:00:01'])
+            self.assertEqual(client.issued_mac_addresses(['60:36:96:10:00:03', '60:36:96:10:00:04']), ['60:36:96:10:00:04'])
+            file_data = client.process_file_atomicaly()
+        finally:
+            server.shutdown()
+            thread.join()
+        self.assertEqual(file_data, [(5, 3, '60:36:96:10:00:03'), (6, 5, '60:36:96:10:00:05')])
+        self.assertEqual(LocalFileProcess(self._local_file_path).read(), (6, 5, '60:36:96:10:00:05'))
+        # After a restart the total numbers of the issued serial numbers are loaded from the file
+        server, thread = self._start_server()
+        try:
+            client.release_atomicaly(['60:36:96:10:00:04'])
+            with self.assertRaisesRegex(RuntimeError, 'not issued'):
+                client.release_atomicaly(['60:36:96:10:00:04'])
+        finally:
+            server.shutdown()
+            thread.join()
+        with open(self._local_file_path) as f:
+            words = f.readlines()[-2].split()
+        self.assertEqual(words[:3] + words[5:], ['4', '0004', '60:36:96:10:00:04', 'RELEASED'])
+
+    def test_journal_replay(self):
+        local_storage = LocalFileProcess(self._local_file_path)
+        local_storage.create(mac=self._mac_process.serial_to_mac(0))
+        size = os.path.getsize(self._local_file_path)
+        # Crash: the first line reached the file partially, the last line is not complete
+        lines = [local_storage.format_entry(*entry) for entry in self._mac_process.generate_mac_address_list(0, 0)]
+        with open(self._local_file_path, 'a') as f:
+            f.write(lines[0][:10])
+        with open(self._journal_path, 'w') as f:
+            f.write(f"# {size}\n" + ''.join(lines) + "3       0003")
+        server, thread = self._start_server()
+        try:
+            file_data = HemcdFileProcess().process_file_atomicaly()
+        finally:
+            server.shutdown()
+            thread.join()
+        self.assertEqual(file_data[0], (3, 3, '60:36:96:10:00:03'))
+        with open(self._local_file_path) as f:
+            self.assertEqual(len(f.readlines()), 6)
+
+    def test_restricted_commands(self):
+        server, thread = self._start_server()
+        try:
+            server.init()
+            client = HemcdFileProcess()
+            with self.assertRaises(RuntimeError):
+                client.cleanup()
+            with self.assertRaises(RuntimeError):
+                HemcdClient.connect().request({"command": "cleanup"})
+            with self.assertRaises(RuntimeError):
+                client.process_file_atomicaly(num_of_blocks=HEMCD_MAX_NUM_OF_BLOCKS + 1)
+            self.assertEqual(client.process_file_atomicaly()[0], (1, 1, '60:36:96:10:00:01'))
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def test_tcp_requires_secret(self):
+        with self.assertRaises(ValueError):
+            self._start_server('127.0.0.1')
+        server, thread = self._start_server('127.0.0.1', secret='s3cret')
+        try:
+            server.init()
+            port = server._socket_server.server_address[1]
+            HemcdClient.init(server='127.0.0.1', password='wrong', port=port)
+            with self.assertRaises(RuntimeError):
+                HemcdFileProcess().process_file_atomicaly()
+            HemcdClient.init(server='127.0.0.1', password='s3cret', port=port)
+            file_data = HemcdFileProcess().process_file_atomicaly()
+        finally:
+            server.shutdown()
+            thread.join()
+        self.assertEqual(file_data[0], (1, 1, '60:36:96:10:00:01'))
+
+
+class SlowLocalDirClient(LocalDirClient):
+    """
+    Download takes long enough to cancel the allocation in the middle.
+    """
+    def get(self, remote_path, local_path):
+        threading.Event().wait(0.3)
+        super().get(remote_path, local_path)
+
+
+class BrokenLocalDirClient(LocalDirClient):
+    """
+    The connection is lost after the mutex is locked: download and unlock fail.
+    """
+    def get(self, remote_path, local_path):
+        raise IOError("Download failed, connection lost.")
+
+    def rename(self, old_path, new_path):
+        if old_path == 'mutex.locked':
+            raise IOError("Unlock failed, connection lost.")
+        super().rename(old_path, new_path)
+
+
+class TestAsyncRemoteFileProcess(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _remote_file_process_for(self, name, client_cls=LocalDirClient):
+        # Every server has its own directory and its own remote storage class
+        remote_dir = os.path.join(self._tmp.name, name)
+        os.mkdir(remote_dir)
+        remote_storage_cls = type(name, (client_cls,), {})
+        remote_storage_cls.init(remote_dir)
+        return new_remote_file_process(self._tmp.name, name, remote_storage_cls)
+
+    def test_allocate_on_several_servers(self):
+        remote_file_process1 = self._remote_file_process_for('server1')
+
+        async def allocate():
+            async with AsyncRemoteFileProcess(remote_file_process1) as server1, \
+                       AsyncRemoteFileProcess(self._remote_file_process_for('server2')) as server2:
+                await asyncio.gather(server1.init(), server2.init())
+                await server1.allocate()
+                return await asyncio.gather(server1.allocate(), server2.allocate(num_of_blocks=2))
+
+        file_data1, file_data2 = asyncio.run(allocate())
+        self.assertEqual(file_data1, [(3, 3, '60:36:96:10:00:03'), (4, 4, '60:36:96:10:00:04')])
+        self.assertEqual(remote_file_process1.file_data, file_data1)
+        self.assertEqual(len(file_data2), 4)
+        self.assertEqual(file_data2[0], (1, 1, '60:36:96:10:00:01'))
+
+    def test_cancel_unlocks_mutex(self):
+        remote_file_process = self._remote_file_process_for('server', SlowLocalDirClient)
+
+        async def allocate_and_cancel():
+            async with AsyncRemoteFileProcess(remote_file_process) as process:
+                await process.init()
+                task = asyncio.ensure_future(process.allocate())
+                await asyncio.sleep(0.1)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+
+        asyncio.run(allocate_and_cancel())
+        remote_dir = os.path.join(self._tmp.name, 'server')
+        self.assertTrue(os.path.exists(os.path.join(remote_dir, 'mutex.unlocked')))
+        self.assertFalse(os.path.exists(os.path.join(remote_dir, 'mutex.locked')))
+
+    def test_unlock_error_does_not_hide_error(self):
+        remote_file_process = self._remote_file_process_for('server', BrokenLocalDirClient)
+        remote_file_process.init()
+
+        async def allocate():
+            async with AsyncRemoteFileProcess(remote_file_process) as process:
+                await process.allocate()
+
+        # The error of the transaction is raised, not the one of the unlock
+        with self.assertRaisesRegex(IOError, 'Download failed'):
+            asyncio.run(allocate())
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.WARNING)
     logger = logging.getLogger('test_hemc_mac')